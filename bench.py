@@ -0,0 +1,225 @@
+'''
+itl_chorus -- ITL Chorus Suite
+bench -- Benchmark the mkiv conversion pipeline
+
+This script generates synthetic MIDI files with controlled parameters (track
+count, note rate, polyphony, tempo change density, pitchbend/modwheel density
+and volume automation), runs mkiv.py over each of them, and reports the
+per-phase timings and peak memory usage that mkiv.py records with
+--profile-json. The inputs are generated from a fixed seed, so results from
+different commits are directly comparable (see --save and --compare).
+'''
+
+import midi
+import sys
+import os
+import optparse
+import random
+import subprocess
+import tempfile
+import shutil
+import json
+import time
+
+CASES = [
+    # name, generator parameters, extra mkiv.py options
+    ('baseline', {}, []),
+    ('tracks', {'tracks': 24}, []),
+    ('dense', {'rate': 40.0, 'polyphony': 8}, []),
+    ('tempo', {'tempo_rate': 20.0}, []),
+    ('bend', {'bend_rate': 60.0}, []),
+    ('modwheel', {'modwheel_rate': 10.0}, ['--modwheel-res', '0.05']),
+    ('volume', {'volume_rate': 30.0}, []),
+    ('string', {}, ['--string-res', '0.02', '--string-threshold', '0.2']),
+    ('slack', {'polyphony': 4}, ['--slack', '0.05', '-T']),
+]
+
+DEFAULTS = {
+    'tracks': 4,
+    'rate': 8.0,
+    'polyphony': 2,
+    'tempo_rate': 0.0,
+    'bend_rate': 0.0,
+    'modwheel_rate': 0.0,
+    'volume_rate': 0.0,
+}
+
+parser = optparse.OptionParser(usage='%prog [options] [case...]')
+parser.add_option('-l', '--list', dest='list', action='store_true', help='List the available cases and exit')
+parser.add_option('-s', '--seconds', dest='seconds', type='float', help='Length of each synthetic piece in seconds')
+parser.add_option('-r', '--repeat', dest='repeat', type='int', help='Run each case this many times and keep the fastest run of each phase')
+parser.add_option('--seed', dest='seed', type='int', help='Random seed for the generated MIDI files')
+parser.add_option('--mkiv', dest='mkiv', help='Path to the mkiv.py to benchmark (defaults to the one next to this script)')
+parser.add_option('--python', dest='python', help='Interpreter to run mkiv.py with (defaults to this one)')
+parser.add_option('-o', '--output', dest='output', help='Also write the report to this file')
+parser.add_option('--save', dest='save', help='Save the results as JSON to this file, for later use with --compare')
+parser.add_option('--compare', dest='compare', help='Compare against results previously saved with --save')
+parser.add_option('-k', '--keep', dest='keep', help='Keep the generated MIDI, .iv and profile files in this directory')
+parser.set_defaults(seconds=60.0, repeat=3, seed=0, mkiv=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mkiv.py'), python=sys.executable, output='bench_output.txt')
+options, args = parser.parse_args()
+
+if options.list:
+    for name, params, mkopts in CASES:
+        full = dict(DEFAULTS)
+        full.update(params)
+        print '%-10s %s %s'%(name, ' '.join('%s=%s'%(k, v) for k, v in sorted(full.items())), ' '.join(mkopts))
+    exit()
+
+RESOLUTION = 480
+BASE_BPM = 120
+
+def make_midi(fname, seed, seconds, tracks, rate, polyphony, tempo_rate, bend_rate, modwheel_rate, volume_rate):
+    '''Writes a synthetic MIDI file to fname. Rates are in events per second
+    per track (tempo_rate is global), and polyphony is the mean number of
+    simultaneously sounding notes in each track.'''
+    rng = random.Random(seed)
+    tps = RESOLUTION * BASE_BPM / 60.0
+    length = int(seconds * tps)
+    def count(rate):
+        return int(rate * seconds)
+    def tick():
+        return rng.randint(0, length)
+    pat = midi.Pattern(resolution=RESOLUTION)
+    for t in range(tracks):
+        ch = t % 16
+        evs = [(0, midi.ProgramChangeEvent(channel=ch, value=(t * 8) % 128))]
+        if t == 0:
+            evs.append((0, midi.SetTempoEvent(bpm=BASE_BPM)))
+            for i in xrange(count(tempo_rate)):
+                evs.append((tick(), midi.SetTempoEvent(bpm=rng.randint(60, 240))))
+        dur = max(1, int(polyphony * tps / rate)) if rate else 1
+        for i in xrange(count(rate)):
+            st = tick()
+            d = max(1, int(rng.expovariate(1.0 / dur)))
+            p = rng.randint(30, 90)
+            evs.append((st, midi.NoteOnEvent(channel=ch, pitch=p, velocity=rng.randint(1, 127))))
+            evs.append((st + d, midi.NoteOffEvent(channel=ch, pitch=p, velocity=0)))
+        for i in xrange(count(bend_rate)):
+            evs.append((tick(), midi.PitchWheelEvent(channel=ch, pitch=rng.randint(-8192, 8191))))
+        for i in xrange(count(modwheel_rate)):
+            evs.append((tick(), midi.ControlChangeEvent(channel=ch, control=1, value=rng.randint(0, 127))))
+        for i in xrange(count(volume_rate)):
+            evs.append((tick(), midi.ControlChangeEvent(channel=ch, control=7, value=rng.randint(0, 127))))
+        evs.sort(key=lambda pair: pair[0])
+        trk = midi.Track()
+        last = 0
+        for at, ev in evs:
+            ev.tick = at - last
+            last = at
+            trk.append(ev)
+        trk.append(midi.EndOfTrackEvent(tick=1))
+        pat.append(trk)
+    midi.write_midifile(fname, pat)
+
+def run_case(workdir, name, params, mkopts, seed):
+    '''Generates the MIDI file for a case and converts it options.repeat
+    times, returning the per-phase minimum of the measurements.'''
+    full = dict(DEFAULTS)
+    full.update(params)
+    mid = os.path.join(workdir, name + '.mid')
+    make_midi(mid, seed, options.seconds, **full)
+    best = None
+    for i in range(options.repeat):
+        start = time.time()
+        proc = subprocess.Popen([options.python, options.mkiv, '--no-cache', '--profile-json'] + mkopts + [mid], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.communicate()[0]
+        total = time.time() - start
+        if proc.returncode:
+            print out
+            print name, ': mkiv.py exited with status', proc.returncode
+            return None
+        f = open(os.path.join(workdir, name + '.profile.json'))
+        phases = json.load(f)['phases']
+        f.close()
+        if best is None:
+            best = {'total': total, 'phases': phases}
+            continue
+        best['total'] = min(best['total'], total)
+        for cur, ph in zip(best['phases'], phases):
+            for k in ('wall', 'cpu'):
+                cur[k] = min(cur[k], ph[k])
+            cur['peak_rss'] = min(cur['peak_rss'], ph['peak_rss'])
+    best['params'] = full
+    best['mkiv_options'] = mkopts
+    best['input_size'] = os.path.getsize(mid)
+    return best
+
+def git_revision():
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(options.mkiv)), stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        return proc.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def report(results, baseline, lines):
+    for name, _, _ in CASES:
+        res = results.get(name)
+        if res is None:
+            continue
+        base = baseline.get(name) if baseline else None
+        lines.append('== %s (%s; %s)'%(name, ' '.join('%s=%s'%(k, v) for k, v in sorted(res['params'].items())), ' '.join(res['mkiv_options']) or 'default options'))
+        base_phases = dict((ph['phase'], ph) for ph in base['phases']) if base else {}
+        lines.append('%-10s %9s %9s %9s %10s%s'%('phase', 'wall (s)', 'CPU (s)', 'RSS (MiB)', 'items', '   vs. baseline' if base else ''))
+        for ph in res['phases']:
+            delta = ''
+            bph = base_phases.get(ph['phase'])
+            if bph is not None:
+                delta = '   %+7.1f%%'%(100.0 * (ph['wall'] - bph['wall']) / bph['wall']) if bph['wall'] > 0 else '   n/a'
+            lines.append('%-10s %9.3f %9.3f %9.1f %10s%s'%(ph['phase'], ph['wall'], ph['cpu'], ph['peak_rss'], '-' if ph['items'] is None else ph['items'], delta))
+        delta = ''
+        if base:
+            delta = '   %+7.1f%%'%(100.0 * (res['total'] - base['total']) / base['total'])
+        lines.append('%-10s %9.3f %9s %9.1f %10s%s'%('process', res['total'], '', max(ph['peak_rss'] for ph in res['phases']), '', delta))
+        lines.append('')
+
+selected = [case for case in CASES if not args or case[0] in args]
+unknown = set(args) - set(case[0] for case in CASES)
+if unknown:
+    print 'Unknown cases:', ', '.join(sorted(unknown)), '(try --list)'
+    exit(1)
+
+baseline = None
+if options.compare:
+    f = open(options.compare)
+    baseline = json.load(f)
+    f.close()
+
+if options.keep:
+    workdir = options.keep
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+else:
+    workdir = tempfile.mkdtemp(prefix='itl_bench_')
+
+results = {}
+try:
+    for name, params, mkopts in selected:
+        print 'Running', name, '...'
+        sys.stdout.flush()
+        res = run_case(workdir, name, params, mkopts, options.seed + CASES.index((name, params, mkopts)))
+        if res is not None:
+            results[name] = res
+finally:
+    if not options.keep:
+        shutil.rmtree(workdir)
+
+revision = git_revision()
+lines = ['mkiv.py benchmark: %s, %s seconds per piece, best of %d, seed %d'%(revision or 'unknown revision', options.seconds, options.repeat, options.seed)]
+if baseline:
+    lines.append('Compared against: %s (%s)'%(options.compare, baseline.get('revision') or 'unknown revision'))
+lines.append('')
+report(results, baseline['results'] if baseline else None, lines)
+print '\n'.join(lines)
+
+if options.output:
+    f = open(options.output, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+
+if options.save:
+    f = open(options.save, 'w')
+    json.dump({'revision': revision, 'seconds': options.seconds, 'repeat': options.repeat, 'seed': options.seed, 'results': results}, f, indent=4)
+    f.close()
+
+if len(results) < len(selected):
+    exit(1)
@@ -2,12 +2,15 @@ import socket
 import sys
 import struct
 import time
-import xml.etree.ElementTree as ET
+import ivload
 import threading
 import thread
 import optparse
 import random
 import itertools
+import heapq
+import bisect
+import array
 import re
 import os
 
@@ -46,12 +49,15 @@ parser.add_option('--dry', dest='dry', action='store_true', help='Dry run--don\'
 parser.add_option('--pcm', dest='pcm', action='store_true', help='Use experimental PCM rendering')
 parser.add_option('--pcm-lead', dest='pcmlead', type='float', help='Seconds of leading PCM data to send')
 parser.add_option('--spin', dest='spin', action='store_true', help='Ignore delta times in the queue (busy loop the CPU) for higher accuracy')
+parser.add_option('--cache-size', dest='cache_size', type='float', help='Keep up to this many MiB of loaded pieces in memory, so that repeated pieces start at once (0 disables)')
+parser.add_option('--cache-dir', dest='cache_dir', help='Also keep loaded pieces in this directory between runs (under the same size limit)')
+parser.add_option('--pre-encode', dest='pre_encode', action='store_true', help='Encode the PLAY packets of the whole piece before it starts, rather than a few notes of each stream ahead of time')
 parser.add_option('-G', '--gui', dest='gui', default='', help='set a GUI to use')
 parser.add_option('--pg-fullscreen', dest='fullscreen', action='store_true', help='Use a full-screen video mode')
 parser.add_option('--pg-width', dest='pg_width', type='int', help='Width of the pygame window')
 parser.add_option('--pg-height', dest='pg_height', type='int', help='Width of the pygame window')
 parser.add_option('--help-routes', dest='help_routes', action='store_true', help='Show help about routing directives')
-parser.set_defaults(routes=['T:DRUM=!perc,0'], random=0.0, rand_low=80, rand_high=2000, live=None, factor=1.0, duration=0.25, volume=1.0, wait_time=0.1, tries=5, play=[], transpose=0, seek=0.0, bind_addr='', ports=[13676, 13677],  pg_width = 0, pg_height = 0, number=-1, pcmlead=0.1)
+parser.set_defaults(routes=['T:DRUM=!perc,0'], random=0.0, rand_low=80, rand_high=2000, live=None, factor=1.0, duration=0.25, volume=1.0, wait_time=0.1, tries=5, play=[], transpose=0, seek=0.0, bind_addr='', ports=[13676, 13677],  pg_width = 0, pg_height = 0, number=-1, pcmlead=0.1, cache_size=256)
 options, args = parser.parse_args()
 
 if options.help_routes:
@@ -144,6 +150,55 @@ factor = options.factor
 
 print 'Factor:', factor
 
+PLAY_HEAD = struct.Struct('>LLLLf')  # As str(Packet(CMD.PLAY, ...)) up to the port
+PLAY_TAIL = struct.Struct('>LLLL')  # The port and padding
+PLAY_RING = 64  # PLAY packets encoded ahead of time, per stream and port
+
+class PlayNotes(object):
+    '''The time-sorted notes of a stream compiled for playback, so that
+    nothing but indexing is left to do when they are due. time is in the
+    piece, due in seconds after BASETIME; dur, secs and usecs (the PLAY
+    duration), freq and vol (the PLAY amplitude) have factor, transpose and
+    volume applied. pitch (transposed) and ampl are what playing_notes shows.
+
+    packets maps each client port playing the stream to a ring of encoded
+    PLAY packets: note i is at i % ring, for notes up to (but not including)
+    encoded.'''
+    __slots__ = ['time', 'due', 'dur', 'secs', 'usecs', 'freq', 'vol', 'pitch', 'ampl', 'end', 'packets', 'ring', 'encoded']
+    def __init__(self, notes):
+        self.time = notes.time
+        self.due = array.array('d', (t * factor for t in notes.time))
+        self.dur = array.array('d', (d * factor for d in notes.dur))
+        self.secs = array.array('l', (int(d) for d in self.dur))
+        self.usecs = array.array('l', (int((d*1000000)%1000000) for d in self.dur))
+        self.pitch = array.array('d', (p + options.transpose for p in notes.pitch))
+        self.freq = array.array('l', (int(440.0 * 2**((p-69)/12.0)) for p in self.pitch))
+        self.vol = array.array('d', (a * options.volume for a in notes.ampl))
+        self.ampl = notes.ampl
+        self.end = notes.End()
+        self.packets = {}
+        self.ring = max(1, len(self) if options.pre_encode else PLAY_RING)
+        self.encoded = 0
+    def __len__(self):
+        return len(self.time)
+    def Encode(self, ports, lo, hi):
+        '''Encodes the PLAY packets of notes lo to hi (no more than a ring)
+        for each of ports.'''
+        rings = []
+        for port in ports:
+            if port not in self.packets:
+                self.packets[port] = [None] * self.ring
+            rings.append((self.packets[port], PLAY_TAIL.pack(port, 0, 0, 0)))
+        for idx in xrange(lo, hi):
+            head = PLAY_HEAD.pack(CMD.PLAY, self.secs[idx], self.usecs[idx], self.freq[idx], self.vol[idx])
+            slot = idx % self.ring
+            for ring, tail in rings:
+                ring[slot] = head + tail
+        self.encoded = hi
+    def Find(self, t):
+        '''The index of the first note at or after (piece) time t.'''
+        return bisect.bisect_left(self.time, t)
+
 try:
     rows, columns = map(int, os.popen('stty size', 'r').read().split())
 except Exception:
@@ -350,8 +405,12 @@ if options.live or options.list_live:
 if options.repeat:
     args = itertools.cycle(args)
 
+scores = None
+if options.cache_size > 0:
+    scores = ivload.ScoreCache(int(options.cache_size * 1024 * 1024), options.cache_dir)
+
 for fname in args:
-    if options.pcm and not fname.endswith('.iv'):
+    if options.pcm and not fname.endswith(('.iv', '.ivb')):
         print 'PCM: play', fname
         if fname == '-':
             import wave
@@ -399,15 +458,18 @@ for fname in args:
         print 'PCM: exit'
         continue
     try:
-        iv = ET.parse(fname).getroot()
+        if scores is not None:
+            iv = scores.Load(fname)
+        else:
+            iv = ivload.load(fname, True)
+        notestreams = iv.NoteStreams()
     except IOError:
         import traceback
         traceback.print_exc()
         print fname, ': Bad file'
         continue
 
-    notestreams = iv.findall("./streams/stream[@type='ns']")
-    groups = set([ns.get('group') for ns in notestreams if 'group' in ns.keys()])
+    groups = iv.Groups()
     number = (len(notestreams) * abs(options.number) if options.number < 0 else options.number)
     print len(notestreams), 'notestreams'
     print len(clients), 'clients'
@@ -463,7 +525,7 @@ for fname in args:
             self.routes = []
         def Route(self, stream):
             testset = self.clients
-            grp = stream.get('group', 'ALL')
+            grp = stream.attrib.get('group', 'ALL')
             if options.verbose:
                 print 'Routing', grp, '...'
             excl = False
@@ -536,24 +598,26 @@ for fname in args:
                 self.done = False
                 self.cur_offt = None
                 self.next_t = None
+                self.pos = 0  # Index of the next note to play
             def actuate_missed(self):
                 nsq, cls = self._Thread__args
                 dur = None
                 i = 0
-                while nsq and float(nsq[0].get('time'))*factor <= time.time() - BASETIME:
+                while self.pos < len(nsq) and nsq.due[self.pos] <= time.time() - BASETIME:
                     i += 1
-                    note = nsq.pop(0)
-                    ttime = float(note.get('time'))
-                    pitch = float(note.get('pitch')) + options.transpose
-                    ampl = float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0))
-                    dur = factor*float(note.get('dur'))
+                    idx = self.pos
+                    self.pos += 1
+                    ttime, dur, pitch, ampl = nsq.time[idx], nsq.dur[idx], nsq.pitch[idx], nsq.ampl[idx]
                     if options.verbose:
                         print (time.time() - BASETIME) / options.factor, ': PLAY', pitch, dur, ampl
                     if options.dry:
                         playing_notes[self.nsid] = (pitch, ampl)
                     else:
+                        if idx >= nsq.encoded:  # Fell more than a ring behind
+                            self.encode_ahead(idx)
+                        slot = idx % nsq.ring
                         for cl in cls:
-                            s.sendto(str(Packet(CMD.PLAY, int(dur), int((dur*1000000)%1000000), int(440.0 * 2**((pitch-69)/12.0)), ampl * options.volume, cl[2])), cl[:2])
+                            s.sendto(nsq.packets[cl[2]][slot], cl[:2])
                             playing_notes[cl] = (pitch, ampl)
                 if i > 0 and dur is not None:
                     self.cur_offt = ttime + dur / options.factor
@@ -569,18 +633,28 @@ for fname in args:
                                 for cl in cls:
                                     playing_notes[cl] = (0, 0)
                 next_act = None
-                if nsq:
-                    next_act = float(nsq[0].get('time'))
+                if self.pos < len(nsq):
+                    next_act = nsq.time[self.pos]
                 if options.verbose:
                     print 'NEXT_ACT:', next_act, 'CUR_OFFT:', self.cur_offt
                 self.next_t = min((next_act or float('inf'), self.cur_offt or float('inf')))
-                self.done = not (nsq or self.cur_offt)
+                self.done = not (self.pos < len(nsq) or self.cur_offt)
+                self.encode_ahead(self.pos)
+            def encode_ahead(self, pos):
+                # Refills the packet rings with the notes from pos on
+                nsq, cls = self._Thread__args
+                if options.dry:
+                    return
+                lo = max(nsq.encoded, pos)
+                hi = min(len(nsq), pos + nsq.ring)
+                if lo < hi:
+                    nsq.Encode(set(cl[2] for cl in cls), lo, hi)
             def drop_missed(self):
                 nsq, cl = self._Thread__args
-                cnt = 0
-                while nsq and float(nsq[0].get('time'))*factor < time.time() - BASETIME:
-                    nsq.pop(0)
-                    cnt += 1
+                pos = max(self.pos, nsq.Find((time.time() - BASETIME) / factor))
+                cnt = pos - self.pos
+                self.pos = pos
+                self.encode_ahead(pos)
                 if options.verbose:
                     print self, 'dropped', cnt, 'notes due to miss'
             def wait_for(self, t):
@@ -589,22 +663,21 @@ for fname in args:
                 time.sleep(t)
             def run(self):
                     nsq, cls = self._Thread__args
-                    for note in nsq:
-                            ttime = float(note.get('time'))
-                            pitch = float(note.get('pitch')) + options.transpose
-                            ampl = float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0))
-                            dur = factor*float(note.get('dur'))
-                            while time.time() - BASETIME < factor*ttime:
-                                self.wait_for(factor*ttime - (time.time() - BASETIME))
+                    for idx in xrange(self.pos, len(nsq)):
+                            due, dur, pitch, ampl = nsq.due[idx], nsq.dur[idx], nsq.pitch[idx], nsq.ampl[idx]
+                            while time.time() - BASETIME < due:
+                                self.wait_for(due - (time.time() - BASETIME))
                             if options.dry:
                                 cl = self.nsid  # XXX hack
                             else:
+                                if idx >= nsq.encoded:
+                                    self.encode_ahead(idx)
                                 for cl in cls:
-                                    s.sendto(str(Packet(CMD.PLAY, int(dur), int((dur*1000000)%1000000), int(440.0 * 2**((pitch-69)/12.0)), ampl * options.volume, cl[2])), cl[:2])
+                                    s.sendto(nsq.packets[cl[2]][idx % nsq.ring], cl[:2])
                             if options.verbose:
                                 print (time.time() - BASETIME), cl, ': PLAY', pitch, dur, vel
                             playing_notes[cl] = (pitch, ampl)
-                            self.wait_for(dur - ((time.time() - BASETIME) - factor*ttime))
+                            self.wait_for(dur - ((time.time() - BASETIME) - due))
                             playing_notes[cl] = (0, 0)
                     if options.verbose:
                         print '% 6.5f'%(time.time() - BASETIME,), cl, ': DONE'
@@ -612,9 +685,7 @@ for fname in args:
     threads = {}
     if options.dry:
         for nsid, ns in enumerate(notestreams):
-            nsq = ns.findall('note')
-            nsq.sort(key=lambda x: float(x.get('time')))
-            threads[ns] = NSThread(args=(nsq, set()))
+            threads[ns] = NSThread(args=(PlayNotes(ns.Notes().Sorted()), set()))
             threads[ns].nsid = nsid
         targets = threads.values()  # XXX hack
     else:
@@ -622,31 +693,39 @@ for fname in args:
         for idx, ns in zip(xrange(number), nscycle):
             clis = routeset.Route(ns)
             for cli in clis:
-                nsq = ns.findall('note')
-                nsq.sort(key=lambda x: float(x.get('time')))
                 if ns in threads:
                     threads[ns]._Thread__args[1].add(cli)
                 else:
-                    threads[ns] = NSThread(args=(nsq, set([cli])))
+                    threads[ns] = NSThread(args=(PlayNotes(ns.Notes().Sorted()), set([cli])))
 
     if options.verbose:
         print 'Playback threads:'
         for thr in threads.values():
             print thr._Thread__args[1]
 
+    for thr in threads.values():
+        thr.encode_ahead(0)
+
     BASETIME = time.time() - (options.seek*factor)
-    ENDTIME = max(max(float(n.get('time')) + float(n.get('dur')) for n in thr._Thread__args[0]) for thr in threads.values())
+    ENDTIME = max(thr._Thread__args[0].end for thr in threads.values())
     print 'Playtime is', ENDTIME
     if options.seek > 0:
         for thr in threads.values():
             thr.drop_missed()
     spin_phase = 0
     SPINNERS = ['-', '\\', '|', '/']
-    while not all(thr.done for thr in threads.values()):
-        for thr in threads.values():
-            if thr.next_t is None or factor * thr.next_t <= time.time() - BASETIME:
-                thr.actuate_missed()
-        delta = factor * min(thr.next_t for thr in threads.values() if thr.next_t is not None) + BASETIME - time.time()
+    # Every thread that isn't done is queued once, by the (piece) time it next
+    # needs to be actuated; only the threads that are due are visited.
+    sched = [(float('-inf'), idx, thr) for idx, thr in enumerate(threads.values())]
+    while sched:
+        while sched and factor * sched[0][0] <= time.time() - BASETIME:
+            next_t, idx, thr = heapq.heappop(sched)
+            thr.actuate_missed()
+            if not thr.done:
+                heapq.heappush(sched, (thr.next_t, idx, thr))
+        if not sched:
+            break
+        delta = factor * sched[0][0] + BASETIME - time.time()
         if delta == float('inf'):
             print 'WARNING: Infinite postponement detected! Did all notestreams finish?'
             break
@@ -1,4 +1,5 @@
 from xml.etree import ElementTree as ET
+import ivload
 import optparse
 import os
 
@@ -16,7 +17,8 @@ class Note(object):
 
 for fname in args:
     try:
-        iv = ET.parse(fname).getroot()
+        iv = ivload.load(fname, True)
+        notestreams = iv.NoteStreams()
     except IOError:
         import traceback
         traceback.print_exc()
@@ -25,7 +27,6 @@ for fname in args:
 
     print '----', fname, '----'
 
-    notestreams = iv.findall("./streams/stream[@type='ns']")
     print len(notestreams), 'notestreams'
 
     print 'Loading all events...'
@@ -35,13 +36,8 @@ for fname in args:
     dur = 0.0
 
     for ns in notestreams:
-        for note in ns.findall('note'):
-            n = Note(
-                float(note.get('time')),
-                float(note.get('dur')),
-                float(note.get('pitch')),
-                float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0)),
-            )
+        for note in ns.Notes():
+            n = Note(*note)
             evs.append(n)
             if n.time + n.dur > dur:
                 dur = n.time + n.dur
@@ -85,7 +81,7 @@ for fname in args:
     print 'Writing out schedule...'
 
     newiv = ET.Element('iv')
-    newiv.append(iv.find('meta'))
+    newiv.append(iv.Meta())
     newivstreams = ET.SubElement(newiv, 'streams')
     newivstream = ET.SubElement(newivstreams, 'stream', type='ns')
 
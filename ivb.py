@@ -0,0 +1,284 @@
+'''
+itl_chorus -- ITL Chorus Suite
+ivb -- Binary interval files
+
+An .ivb file holds the same document as an XML .iv file, except that the
+notes of each note stream are stored as an array of fixed-width records which
+can be used straight out of a memory mapping, instead of as one XML element
+per note. All integers and floats are little-endian:
+
+- Header: magic "IVB\\0", u16 version (1), u16 record size (40), u32 stream
+  count, u32 reserved (0), u64 offset and u64 length of the document.
+- Stream table, an entry per stream element in document order: u64 offset
+  and u64 count of its note records, u16 length of its type and u16 length of
+  its group (0xFFFF if it has none), followed by the type and group (UTF-8).
+- The note records of each note stream, 8-byte aligned: f64 time, f64 dur,
+  f64 pitch, f64 ampl, i32 vel and u32 flags (FLAG_*).
+- The document: the XML of the .iv with every note element removed. The meta
+  element and any text and aux streams are kept there as they are.
+
+Conversion is lossless for the notes mkiv.py (and the other tools) write;
+notes with other attributes, or numbers that would not be written back the
+same way, are refused with a ValueError. Whitespace between notes is dropped.
+
+Run this module as a script to convert files in either direction.
+'''
+
+import xml.etree.ElementTree as ET
+import mmap
+import struct
+import array
+import sys
+import os
+import smf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'IVB\0'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIIQQ')
+STREAM = struct.Struct('<QQHH')
+RECORD = struct.Struct('<ddddiI')
+NO_GROUP = 0xFFFF
+
+FLAG_INT_PITCH = 1  # The pitch was written as an integer ("64", not "64.0")
+FLAG_NO_AMPL = 2  # There was no ampl attribute (ampl holds vel / 127.0)
+FLAG_NO_VEL = 4  # There was no vel attribute (vel holds 0)
+
+NOTE_ATTRS = frozenset(['time', 'dur', 'pitch', 'ampl', 'vel'])
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('time', '<f8'), ('dur', '<f8'), ('pitch', '<f8'), ('ampl', '<f8'), ('vel', '<i4'), ('flags', '<u4')])
+
+def is_ivb(fname):
+    '''Whether the named file is an .ivb (rather than an XML .iv).'''
+    f = open(fname, 'rb')
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+
+def parse(fname):
+    '''Returns the root element of the document in the named .iv or .ivb
+    file, so that tools can read either.'''
+    if is_ivb(fname):
+        ivb = load(fname)
+        try:
+            return ivb.Element()
+        finally:
+            ivb.Close()
+    return ET.parse(fname).getroot()
+
+def exact_float(note, attr):
+    value = note.get(attr)
+    if value is None:
+        raise ValueError('note without %s: %r'%(attr, note.attrib))
+    num = float(value)
+    if str(num) != value:
+        raise ValueError('note %s %r would not be written back as is'%(attr, value))
+    return num
+
+def note_record(note):
+    '''Packs a note element into a record, or raises ValueError if it can't be
+    packed losslessly.'''
+    if len(note) or (note.text and note.text.strip()) or not NOTE_ATTRS.issuperset(note.keys()):
+        raise ValueError('note cannot be represented: %r'%(note.attrib,))
+    flags = 0
+    pitch = note.get('pitch')
+    try:
+        ipitch = int(pitch)
+    except (TypeError, ValueError):
+        pitch = exact_float(note, 'pitch')
+    else:
+        if str(ipitch) != pitch:
+            raise ValueError('note pitch %r would not be written back as is'%(pitch,))
+        pitch = float(ipitch)
+        flags |= FLAG_INT_PITCH
+    vel = note.get('vel')
+    if vel is not None:
+        if str(int(vel)) != vel:
+            raise ValueError('note vel %r would not be written back as is'%(vel,))
+        vel = int(vel)
+    else:
+        flags |= FLAG_NO_VEL
+        vel = 0
+    if note.get('ampl') is None:
+        flags |= FLAG_NO_AMPL
+        ampl = (127 if flags & FLAG_NO_VEL else vel) / 127.0
+    else:
+        ampl = exact_float(note, 'ampl')
+    return RECORD.pack(exact_float(note, 'time'), exact_float(note, 'dur'), pitch, ampl, vel, flags)
+
+def note_attrs(time, dur, pitch, ampl, vel, flags):
+    '''The attributes of the note element for the fields of a record.'''
+    attrs = {'time': str(time), 'dur': str(dur), 'pitch': str(int(pitch)) if flags & FLAG_INT_PITCH else str(pitch)}
+    if not flags & FLAG_NO_AMPL:
+        attrs['ampl'] = str(ampl)
+    if not flags & FLAG_NO_VEL:
+        attrs['vel'] = str(vel)
+    return attrs
+
+def write(fname, root):
+    '''Writes the .iv document with the given root element to the named file
+    as an .ivb. The notes are taken out of root in the process.'''
+    streams = root.findall('./streams/stream')
+    records = []
+    for stream in streams:
+        if stream.get('type') == 'ns':
+            records.append(''.join(note_record(note) for note in stream.findall('note')))
+            for note in stream.findall('note'):
+                stream.remove(note)
+            if not len(stream):
+                stream.text = None
+        else:
+            if stream.find('note') is not None:
+                raise ValueError('notes outside of a note stream cannot be represented')
+            records.append('')
+    entries = []
+    for stream in streams:
+        stype = stream.get('type', '').encode('utf8')
+        group = stream.get('group')
+        group = None if group is None else group.encode('utf8')
+        entries.append((stype, group))
+    doc = ET.tostring(root, 'utf-8')
+    pos = HEADER.size + sum(STREAM.size + len(stype) + len(group or '') for stype, group in entries)
+    pos += -pos % 8
+    offsets = []
+    for recs in records:
+        offsets.append(pos)
+        pos += len(recs)
+    f = open(fname, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(streams), 0, pos, len(doc)))
+        for (stype, group), offset, recs in zip(entries, offsets, records):
+            f.write(STREAM.pack(offset, len(recs) // RECORD.size, len(stype), NO_GROUP if group is None else len(group)))
+            f.write(stype + (group or ''))
+        f.write('\0' * (-f.tell() % 8))
+        for recs in records:
+            f.write(recs)
+        f.write(doc)
+    finally:
+        f.close()
+
+class IVBStream(object):
+    '''A stream of an .ivb. For note streams, time, dur, pitch, ampl, vel and
+    flags are columns of the note records--NumPy views of the mapped file if
+    NumPy is available, and arrays otherwise.'''
+    __slots__ = ['type', 'group', 'element', 'count', 'time', 'dur', 'pitch', 'ampl', 'vel', 'flags']
+    def __init__(self, stype, group, element, buf, offset, count):
+        self.type = stype
+        self.group = group
+        self.element = element
+        self.count = count
+        if numpy is not None:
+            if count:
+                recs = numpy.frombuffer(buf, RECORD_DTYPE, count, offset)
+            else:
+                recs = numpy.zeros(0, RECORD_DTYPE)
+            for name in RECORD_DTYPE.names:
+                setattr(self, name, recs[name])
+        else:
+            data = buf[offset:offset + count * RECORD.size]
+            floats = array.array('d', data)
+            ints = array.array('i', data)
+            flags = array.array('I', data)
+            if sys.byteorder == 'big':
+                for arr in (floats, ints, flags):
+                    arr.byteswap()
+            self.time, self.dur, self.pitch, self.ampl = [floats[i::5] for i in range(4)]
+            self.vel = ints[8::10]
+            self.flags = flags[9::10]
+    def __len__(self):
+        return self.count
+    def Records(self):
+        '''Yields (time, dur, pitch, ampl, vel, flags) for each note.'''
+        cols = [self.time, self.dur, self.pitch, self.ampl, self.vel, self.flags]
+        if numpy is not None:
+            cols = [col.tolist() for col in cols]
+        return zip(*cols)
+
+class IVBFile(object):
+    '''An .ivb mapped into memory: root is the document (without notes), and
+    streams an IVBStream per stream element, in document order.'''
+    __slots__ = ['buf', 'root', 'streams']
+    def __init__(self, buf):
+        self.buf = buf
+        if len(buf) < HEADER.size:
+            raise ValueError('truncated .ivb header')
+        magic, version, recsize, nstreams, _, docpos, doclen = HEADER.unpack(buf[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError('not an .ivb file')
+        if version != VERSION or recsize != RECORD.size:
+            raise ValueError('unsupported .ivb version %d (record size %d)'%(version, recsize))
+        if docpos + doclen > len(buf):
+            raise ValueError('truncated .ivb file')
+        self.root = ET.fromstring(buf[docpos:docpos + doclen])
+        elements = self.root.findall('./streams/stream')
+        if len(elements) != nstreams:
+            raise ValueError('.ivb stream table does not match its document')
+        self.streams = []
+        pos = HEADER.size
+        for element in elements:
+            offset, count, typelen, grouplen = STREAM.unpack(buf[pos:pos + STREAM.size])
+            pos += STREAM.size
+            stype = buf[pos:pos + typelen].decode('utf8')
+            pos += typelen
+            group = None
+            if grouplen != NO_GROUP:
+                group = buf[pos:pos + grouplen].decode('utf8')
+                pos += grouplen
+            if offset + count * RECORD.size > docpos:
+                raise ValueError('truncated .ivb stream')
+            self.streams.append(IVBStream(stype, group, element, buf, offset, count))
+    def Element(self):
+        '''Fills the notes into the stream elements of root and returns it.'''
+        for stream in self.streams:
+            for rec in stream.Records():
+                ET.SubElement(stream.element, 'note', note_attrs(*rec))
+        return self.root
+    def Close(self):
+        '''Unmaps the file; the columns of the streams must not be used after
+        this.'''
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+def load(fname):
+    '''Maps the named .ivb into memory, returning an IVBFile.'''
+    buf = smf.map_file(fname)
+    try:
+        return IVBFile(buf)
+    except Exception:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        raise
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options] file...', description='Converts XML .iv files to binary .ivb files, and .ivb files back to .iv.')
+    parser.add_option('-o', '--output', dest='output', help='Output file name (only with a single input; defaults to the input with its extension swapped)')
+    options, args = parser.parse_args()
+    if options.output and len(args) != 1:
+        parser.error('--output needs exactly one input file')
+
+    failed = False
+    for fname in args:
+        try:
+            binary = is_ivb(fname)
+            base, ext = os.path.splitext(fname)
+            out = options.output or (base + ('.iv' if binary else '.ivb'))
+            if binary:
+                ET.ElementTree(parse(fname)).write(out, 'UTF-8')
+            else:
+                write(out, ET.parse(fname).getroot())
+        except (IOError, ValueError, SyntaxError) as e:
+            print fname, ':', e
+            failed = True
+            continue
+        print fname, '->', out
+    if failed:
+        exit(1)
@@ -0,0 +1,310 @@
+'''
+itl_chorus -- ITL Chorus Suite
+ivload -- Shared interval file loader
+
+load() opens an interval file (.iv, or .ivb--see ivb.py) without reading all
+of it. The meta element only needs the start of the file. The list of streams
+(with their types and groups) takes one iterparse pass, which throws every
+note element away as soon as it has been seen, so memory stays flat however
+long the piece is. The notes of a stream are read the first time they are
+asked for--those of every note stream at once, in one more pass, unless
+load() was told to keep them in the first--and are kept as compact columns.
+
+A ScoreCache keeps loaded files (with their notes sorted by time) around for
+players like broadcast.py that load the same pieces over and over.
+'''
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import array
+import itertools
+import operator
+import collections
+import cPickle
+import hashlib
+import os
+import re
+import ivb
+
+def column_array(col):
+    # An .ivb column (a NumPy view of little-endian records, or an array
+    # without NumPy) as an array('d') of its own
+    if isinstance(col, array.array):
+        return col
+    return array.array('d', col.astype(float).tostring())
+
+class Notes(object):
+    '''The notes of a stream, as parallel array('d') columns in file order
+    (or time order, from Sorted()). Iterating yields (time, dur, pitch,
+    ampl) tuples.'''
+    __slots__ = ['time', 'dur', 'pitch', 'ampl']
+    def __init__(self, time=None, dur=None, pitch=None, ampl=None):
+        self.time = array.array('d') if time is None else time
+        self.dur = array.array('d') if dur is None else dur
+        self.pitch = array.array('d') if pitch is None else pitch
+        self.ampl = array.array('d') if ampl is None else ampl
+    def __len__(self):
+        return len(self.time)
+    def __iter__(self):
+        return itertools.izip(self.time, self.dur, self.pitch, self.ampl)
+    def __getitem__(self, i):
+        return (self.time[i], self.dur[i], self.pitch[i], self.ampl[i])
+    def Append(self, note):
+        # Appends a note element, which may have only vel instead of ampl
+        self.time.append(float(note.get('time')))
+        self.dur.append(float(note.get('dur')))
+        self.pitch.append(float(note.get('pitch')))
+        self.ampl.append(float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0)))
+    def End(self):
+        '''The time at which the last note ends.'''
+        return max(itertools.imap(float.__add__, self.time, self.dur)) if self.time else 0.0
+    def Sorted(self):
+        '''These notes, stably sorted by time (self, if they already are).'''
+        if all(itertools.imap(operator.le, self.time, itertools.islice(self.time, 1, None))):
+            return self
+        order = sorted(xrange(len(self)), key=self.time.__getitem__)
+        return Notes(*[array.array('d', (col[i] for i in order)) for col in (self.time, self.dur, self.pitch, self.ampl)])
+
+class Stream(object):
+    '''A stream of an interval file. Other than note streams (whose notes
+    are read by Notes()), the stream element is kept whole in element.'''
+    __slots__ = ['iv', 'index', 'type', 'group', 'attrib', 'element', 'notes']
+    def __init__(self, iv, index, element):
+        self.iv = iv
+        self.index = index
+        self.type = element.get('type')
+        self.group = element.get('group')
+        self.attrib = dict(element.attrib)
+        self.element = element
+        self.notes = None
+    def Notes(self):
+        if self.notes is None:
+            self.iv.LoadNotes()
+        return self.notes
+
+class IVFile(object):
+    '''An interval file opened by load(); everything is read on demand.'''
+    __slots__ = ['fname', 'keep_notes', 'binary', 'attrib', 'meta', 'streams', 'notes_loaded']
+    def __init__(self, fname, keep_notes=False):
+        self.fname = fname
+        self.keep_notes = keep_notes
+        self.binary = None
+        if ivb.is_ivb(fname):
+            self.binary = ivb.load(fname)
+            self.attrib = dict(self.binary.root.attrib)
+            self.meta = self.binary.root.find('meta')
+            self.streams = [Stream(self, idx, bs.element) for idx, bs in enumerate(self.binary.streams)]
+        else:
+            self.attrib = None
+            self.meta = None
+            self.streams = None
+        self.notes_loaded = False
+    def Scan(self, notes=False, until_meta=False):
+        # One iterparse pass: records the root attributes, the meta element
+        # and the streams, discarding note elements (after keeping them as
+        # Notes, if notes is set), and stops after the meta if until_meta is.
+        f = open(self.fname, 'rb')
+        try:
+            streams = []
+            stack = []
+            cur = None  # The Stream being read
+            for event, elem in ET.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if not stack:
+                        self.attrib = dict(elem.attrib)
+                    elif elem.tag == 'stream' and len(stack) == 2 and stack[1].tag == 'streams':
+                        cur = Stream(self, len(streams), elem)
+                        if notes and cur.type == 'ns':
+                            cur.notes = Notes()
+                        streams.append(cur)
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if cur is not None and elem.tag == 'note' and cur.type == 'ns' and stack[-1] is cur.element:
+                    if notes:
+                        cur.notes.Append(elem)
+                    cur.element.remove(elem)
+                elif elem is getattr(cur, 'element', None):
+                    cur = None
+                elif elem.tag == 'meta' and len(stack) == 1:
+                    self.meta = elem
+                    if until_meta:
+                        return
+        finally:
+            f.close()
+        if self.streams is None:
+            self.streams = streams
+        elif notes:
+            for old, new in zip(self.streams, streams):
+                old.notes = new.notes
+        if notes:
+            self.notes_loaded = True
+    def Attrib(self):
+        '''The attributes of the root element.'''
+        if self.attrib is None:
+            self.Scan(until_meta=True)
+        return self.attrib
+    def Meta(self):
+        '''The meta element (or None), reading no further than it.'''
+        if self.meta is None and self.streams is None:
+            self.Scan(until_meta=True)
+        return self.meta
+    def Streams(self):
+        '''All of the Streams, in file order.'''
+        if self.streams is None:
+            self.Scan(self.keep_notes)
+        return self.streams
+    def NoteStreams(self):
+        return [stream for stream in self.Streams() if stream.type == 'ns']
+    def Groups(self):
+        '''The set of groups named by note streams.'''
+        return set(stream.group for stream in self.NoteStreams() if stream.group is not None)
+    def LoadNotes(self):
+        '''Reads the notes of every note stream, if they haven't been.'''
+        if self.notes_loaded:
+            return
+        if self.binary is not None:
+            for stream, bs in zip(self.Streams(), self.binary.streams):
+                if stream.type == 'ns':
+                    stream.notes = Notes(*[column_array(col) for col in (bs.time, bs.dur, bs.pitch, bs.ampl)])
+            self.notes_loaded = True
+            # Nothing refers to the mapping any more
+            self.binary.Close()
+            self.binary = None
+        else:
+            self.Scan(True)
+    def SortNotes(self):
+        '''Reads the notes of every note stream and sorts them by time, in
+        place.'''
+        for stream in self.NoteStreams():
+            stream.notes = stream.Notes().Sorted()
+    def State(self):
+        # Everything read from the file, as plain data that can be pickled
+        streams = []
+        for stream in self.Streams():
+            if stream.type == 'ns':
+                notes = stream.Notes()
+                streams.append((stream.attrib, None, (notes.time, notes.dur, notes.pitch, notes.ampl)))
+            else:
+                streams.append((stream.attrib, ET.tostring(stream.element), None))
+        meta = self.Meta()
+        return (self.Attrib(), None if meta is None else ET.tostring(meta), streams)
+    @classmethod
+    def FromState(cls, fname, state):
+        attrib, meta, streams = state
+        iv = cls.__new__(cls)
+        iv.fname = fname
+        iv.keep_notes = True
+        iv.binary = None
+        iv.attrib = attrib
+        iv.meta = None if meta is None else ET.fromstring(meta)
+        iv.streams = []
+        for attrib, element, notes in streams:
+            stream = Stream(iv, len(iv.streams), ET.Element('stream', attrib) if element is None else ET.fromstring(element))
+            if notes is not None:
+                stream.notes = Notes(*notes)
+            iv.streams.append(stream)
+        iv.notes_loaded = True
+        return iv
+    def Size(self):
+        '''Roughly how many bytes the notes take up.'''
+        return 32 * sum(len(stream.Notes()) for stream in self.NoteStreams())  # Four doubles each
+
+class ScoreCache(object):
+    '''Loaded files, with all their notes read and sorted by time, keyed by
+    path, modification time and size, holding the notes of at most size bytes
+    (least recently used files are evicted first). If path is given, files are
+    also kept there (pickled, under the same limit) between runs.'''
+    VERSION = 1  # Bump when the pickled state changes
+    ENTRY = re.compile(r'^[0-9a-f]{40}\.pickle$')  # Only these files are ours to evict
+    def __init__(self, size, path=None):
+        self.size = size
+        self.path = path
+        self.files = collections.OrderedDict()
+        self.total = 0
+        if path is not None:
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+            self.Evict()
+    @staticmethod
+    def Key(fname):
+        st = os.stat(fname)
+        return (os.path.abspath(fname), st.st_mtime, st.st_size)
+    def Load(self, fname):
+        '''The IVFile of the named file, from the cache if it hasn't changed.'''
+        key = self.Key(fname)
+        iv = self.files.pop(key, None)
+        if iv is None:
+            iv = self.Fetch(key, fname)
+            if iv is None:
+                iv = load(fname, True)
+                iv.SortNotes()
+                self.Store(key, iv)
+            self.total += iv.Size()
+        self.files[key] = iv
+        while self.total > self.size and len(self.files) > 1:
+            old_key, old = self.files.popitem(False)
+            self.total -= old.Size()
+        return iv
+    def Entry(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr((self.VERSION, key))).hexdigest() + '.pickle')
+    def Fetch(self, key, fname):
+        if self.path is None:
+            return None
+        ent = self.Entry(key)
+        try:
+            f = open(ent, 'rb')
+        except IOError:
+            return None
+        try:
+            state = cPickle.load(f)
+        except Exception:  # Truncated or from another version
+            return None
+        finally:
+            f.close()
+        os.utime(ent, None)
+        return IVFile.FromState(fname, state)
+    def Store(self, key, iv):
+        if self.path is None:
+            return
+        ent = self.Entry(key)
+        tmp = '%s.%d.tmp'%(ent, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump(iv.State(), f, 2)
+        finally:
+            f.close()
+        os.rename(tmp, ent)
+        self.Evict()
+    def Evict(self):
+        ents = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not self.ENTRY.match(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            ents.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        ents.sort()
+        for mtime, size, name in ents[:-1]:
+            if total <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+def load(fname, notes=False):
+    '''Opens the named .iv or .ivb. If notes is set, the notes are read along
+    with the list of streams, rather than in a second pass when they are
+    first needed.'''
+    return IVFile(fname, notes)
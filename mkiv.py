@@ -8,10 +8,28 @@ This simple script (using python-midi) reads a MIDI file and makes an interval
 
 import xml.etree.ElementTree as ET
 import midi
+import smf
 import sys
 import os
 import optparse
 import math
+import bisect
+import array
+import itertools
+import heapq
+import numpy
+import time
+import multiprocessing
+import cStringIO as StringIO
+import hashlib
+import json
+import shutil
+import re
+import resource
+import cProfile
+import pstats
+import tempfile
+import collections
 
 TRACKS = object()
 PROGRAMS = object()
@@ -25,16 +43,21 @@ parser.add_option('-t', '--track', dest='tracks', action='append', help='Reserve
 parser.add_option('--help-conds', dest='help_conds', action='store_true', help='Print help on filter conditions for streams')
 parser.add_option('-p', '--program-split', dest='tracks', action='append_const', const=PROGRAMS, help='Ensure all programs are on non-mutual streams (overrides -T presently)')
 parser.add_option('-P', '--percussion', dest='perc', help='Which percussion standard to use to automatically filter to "perc" (GM, GM2, or none)')
-parser.add_option('-f', '--fuckit', dest='fuckit', action='store_true', help='Use the Python Error Steamroller when importing MIDIs (useful for extended formats)')
+parser.add_option('-f', '--fuckit', dest='fuckit', action='store_true', help='Read MIDIs with python-midi under the Python Error Steamroller instead of the built-in reader (which already tolerates most malformed files)')
 parser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Be verbose; show important parts about the MIDI scheduling process')
 parser.add_option('-d', '--debug', dest='debug', action='store_true', help='Debugging output; show excessive output about the MIDI scheduling process (please use less or write to a file)')
 parser.add_option('-D', '--deviation', dest='deviation', type='int', help='Amount (in semitones/MIDI pitch units) by which a fully deflected pitchbend modifies the base pitch (0 disables pitchbend processing)')
+parser.add_option('--bend-cents', dest='bendcents', type='float', help='Don\'t split a note on a pitchbend that moves it by less than this many cents from the pitch it is playing (0 to disable)')
+parser.add_option('--bend-quantum', dest='bendquantum', type='float', help='Don\'t split a note on a pitchbend less than this many seconds after its last split; the bend applies to that whole segment instead (0 to disable)')
 parser.add_option('-M', '--modwheel-freq-dev', dest='modfdev', type='float', help='Amount (in semitones/MIDI pitch unites) by which a fully-activated modwheel modifies the base pitch')
 parser.add_option('--modwheel-freq-freq', dest='modffreq', type='float', help='Frequency of modulation periods (sinusoids) of the modwheel acting on the base pitch')
 parser.add_option('--modwheel-amp-dev', dest='modadev', type='float', help='Deviation [0, 1] by which a fully-activated modwheel affects the amplitude as a factor of that amplitude')
 parser.add_option('--modwheel-amp-freq', dest='modafreq', type='float', help='Frequency of modulation periods (sinusoids) of the modwheel acting on amplitude')
 parser.add_option('--modwheel-res', dest='modres', type='float', help='(Fractional) seconds by which to resolve modwheel events (0 to disable)')
 parser.add_option('--modwheel-continuous', dest='modcont', action='store_true', help='Keep phase continuous in global time (don\'t reset to 0 for each note)')
+parser.add_option('--max-rate', dest='maxrate', type='float', help='Thin modwheel and string model events so that no stream plays more than this many in any one second, counting the notes themselves, which are never dropped (0 for no limit; with --stream, which cannot see a stream\'s next notes coming, these may still take it slightly over)')
+parser.add_option('--rate-cents', dest='ratecents', type='float', help='When thinning for --max-rate, merge an event into the one before it if their pitches differ by less than this many cents (and their amplitudes as per --rate-ampl)')
+parser.add_option('--rate-ampl', dest='rateampl', type='float', help='When thinning for --max-rate, merge an event into the one before it if their amplitudes differ by less than this fraction (and their pitches as per --rate-cents)')
 parser.add_option('--string-res', dest='stringres', type='float', help='(Fractional) seconds by which to resolve string models (0 to disable)')
 parser.add_option('--string-max', dest='stringmax', type='int', help='Maximum number of events to generate per single input event')
 parser.add_option('--string-rate-on', dest='stringonrate', type='float', help='Rate (amplitude / sec) by which to exponentially decay in the string model while a note is active')
@@ -46,7 +69,15 @@ parser.add_option('--slack', dest='slack', type='float', help='Inflate the durat
 parser.add_option('--vol-pow', dest='vol_pow', type='float', help='Exponent to raise volume changes (adjusts energy per delta volume)')
 parser.add_option('-0', '--keep-empty', dest='keepempty', action='store_true', help='Keep (do not cull) events with 0 duration in the output file')
 parser.add_option('--no-text', dest='no_text', action='store_true', help='Disable text streams (useful for unusual text encodings)')
-parser.set_defaults(tracks=[], perc='GM', deviation=2, tempo='global', modres=0.005, modfdev=2.0, modffreq=8.0, modadev=0.5, modafreq=8.0, stringres=0, stringmax=1024, stringrateon=0.7, stringrateoff=0.4, stringthres=0.02, epsilon=1e-12, slack=0.0, vol_pow=2)
+parser.add_option('--no-cache', dest='no_cache', action='store_true', help='Always convert, neither using nor updating the conversion cache (implied by -S, -v, -d and the --profile options, whose output only a conversion produces)')
+parser.add_option('--cache-dir', dest='cache_dir', help='Directory of the conversion cache, which holds results keyed by MIDI contents and options')
+parser.add_option('--cache-size', dest='cache_size', type='float', help='Maximum size of the conversion cache in MiB (least recently used results are evicted)')
+parser.add_option('--profile', dest='profile', action='store_true', help='Print the wall time, CPU time, peak RSS and item count of each conversion phase (disables the cache)')
+parser.add_option('--profile-json', dest='profile_json', action='store_true', help='Write the per-phase profile of each file as JSON to <name>.profile.json (disables the cache)')
+parser.add_option('--profile-phase', dest='profile_phase', help='Run this phase (as named by --profile) under cProfile, writing <name>.<phase>.prof and printing the top entries (disables the cache)')
+parser.add_option('--stream', dest='streaming', action='store_true', help='Convert in (roughly) constant memory: decode the MIDI lazily and spill each stream\'s finished notes to temporary files, which are stitched into the .iv at the end; this is somewhat slower, as modwheel events are resolved and notes finished a few at a time as they are released rather than a stream at a time (cannot be combined with --slack or --string-res)')
+parser.add_option('-j', '--jobs', dest='jobs', type='int', help='Convert this many files at once in separate processes; each file\'s log is printed whole, in order, followed by a summary')
+parser.set_defaults(tracks=[], perc='GM', deviation=2, bendcents=0.0, bendquantum=0.0, tempo='global', modres=0.005, modfdev=2.0, modffreq=8.0, modadev=0.5, modafreq=8.0, stringres=0, stringmax=1024, stringrateon=0.7, stringrateoff=0.4, stringthres=0.02, maxrate=0.0, ratecents=5.0, rateampl=0.05, epsilon=1e-12, slack=0.0, vol_pow=2, jobs=1, cache_dir=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'itl_chorus', 'mkiv'), cache_size=1024)
 options, args = parser.parse_args()
 if options.tempo == 'f1':
     options.tempo == 'global'
@@ -106,87 +137,377 @@ if options.fuckit:
     import fuckit
     midi.read_midifile = fuckit(midi.read_midifile)
 
-for fname in args:
+# The phases of a conversion, as named by --profile, in order
+PHASES = ('read', 'split', 'tempo', 'streams', 'slack', 'modwheel', 'string', 'cull', 'volume', 'check', 'write')
+if options.profile_phase is not None and options.profile_phase not in PHASES:
+    parser.error('--profile-phase must be one of: %s'%(', '.join(PHASES),))
+
+if options.streaming and (options.slack > 0 or options.stringres):
+    print 'WARNING: --stream cannot be used with --slack or --string-res, which repack every note at once; converting in memory instead'
+    options.streaming = False
+
+class IVWriter(object):
+    '''Writes an .iv document to a file as it is generated, producing the same
+    bytes as ET.tostring(root, 'UTF-8') would for the equivalent tree.'''
+    def __init__(self, f):
+        self.f = f
+        self.tags = []
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+    @staticmethod
+    def Attrs(attrs):
+        parts = []
+        for k, v in sorted(attrs.items()):
+            v = v.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace('\n', '&#10;')
+            parts.append(' %s="%s"'%(k, v.encode('utf8', 'xmlcharrefreplace')))
+        return ''.join(parts)
+    def Open(self, tag, **attrs):
+        self.f.write('<%s%s>'%(tag, self.Attrs(attrs)))
+        self.tags.append(tag)
+    def Close(self):
+        self.f.write('</%s>'%(self.tags.pop(),))
+    def Empty(self, tag, **attrs):
+        self.f.write(self.EmptyTag(tag, attrs))
+    def Element(self, elem):
+        ET.ElementTree(elem).write(self.f, 'utf-8')
+    @classmethod
+    def EmptyTag(cls, tag, attrs):
+        return '<%s%s />'%(tag, cls.Attrs(attrs))
+    @staticmethod
+    def NoteTag(ampl, dur, pitch, abstime):
+        return '<note ampl="%s" dur="%s" pitch="%s" time="%s" vel="%s" />'%(ampl, dur, pitch, abstime, int(ampl * 127.0))
+
+RUNTIME_OPTS = set(['-j', '--jobs', '--no-cache', '--cache-dir', '--cache-size', '--profile', '--profile-json', '--profile-phase', '--stream'])
+
+def recorded_argv(argv):
+    '''Returns argv without the options (RUNTIME_OPTS) that only affect how
+    mkiv runs, not the files it writes.'''
+    ret = []
+    argv = iter(argv)
+    for arg in argv:
+        name, eq, _ = arg.partition('=')
+        if name in RUNTIME_OPTS:
+            if parser.get_option(name).takes_value() and not eq:
+                argv.next()
+            continue
+        if not arg.startswith('--') and arg[:2] in RUNTIME_OPTS:
+            continue
+        ret.append(arg)
+    return ret
+
+def root_attrs(fname):
+    '''The attributes of the root element of the .iv converted from fname.'''
+    return {'version': '1', 'src': os.path.basename(fname)}
+
+def args_element():
+    ivargs = ET.Element('args')
+    ivargs.text = ' '.join('%r' % (i,) for i in recorded_argv(sys.argv[1:]))
+    return ivargs
+
+class ConversionCache(object):
+    '''An on-disk cache of converted .iv files, keyed by a hash of mkiv itself
+    (and smf, its MIDI reader), the MIDI file contents and the options that
+    affect the output, holding at most size bytes (least recently used entries
+    are evicted first).'''
+    IGNORED = set(['jobs', 'no_cache', 'cache_dir', 'cache_size', 'profile', 'profile_json', 'profile_phase', 'streaming', 'help_conds'])
+    ENTRY = re.compile(r'^([0-9a-f]{40})\.(iv|json)$')  # Only these files are ours to evict
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):  # Another mkiv may have just made it
+                raise
+        opts = []
+        for k, v in sorted(vars(options).items()):
+            if k in self.IGNORED:
+                continue
+            if k == 'tracks':
+                v = [{TRACKS: '<tracks>', PROGRAMS: '<programs>'}.get(spec, spec) for spec in v]
+            opts.append((k, v))
+        self.base = hashlib.sha1(open(__file__, 'rb').read())
+        self.base.update(open(os.path.splitext(smf.__file__)[0] + '.py', 'rb').read())  # The output depends on the reader too
+        self.base.update(repr(opts))
+        self.Evict()
+    def Key(self, fname):
+        h = self.base.copy()
+        h.update(open(fname, 'rb').read())
+        return h.hexdigest()
+    def Fetch(self, key, fname, dest):
+        ent = os.path.join(self.path, key)
+        try:
+            f = open(ent + '.json')
+            try:
+                stats = json.load(f)
+            finally:
+                f.close()
+            f = open(ent + '.iv', 'rb')
+        except (IOError, ValueError):
+            return None
+        try:
+            # The cached file records the source name and arguments of the run
+            # that made it; swap in ours.
+            head = ''
+            while '</args>' not in head:
+                chunk = f.read(65536)
+                if not chunk:
+                    return None
+                head += chunk
+            args = StringIO.StringIO()
+            ET.ElementTree(args_element()).write(args, 'utf-8')
+            head = re.sub(r'<iv\b[^>]*>', lambda m: '<iv%s>'%(IVWriter.Attrs(root_attrs(fname)),), head, 1)
+            head = re.sub(r'<args>.*?</args>', lambda m: args.getvalue(), head, 1, re.S)
+            out = open(dest, 'wb')
+            out.write(head)
+            shutil.copyfileobj(f, out)
+            out.close()
+        finally:
+            f.close()
+        for ext in ('.iv', '.json'):
+            try:
+                os.utime(ent + ext, None)
+            except OSError:  # Evicted by another mkiv meanwhile
+                pass
+        return tuple(stats)
+    def Store(self, key, src, stats):
+        ent = os.path.join(self.path, key)
+        tmp = '%s.%d.tmp'%(ent, os.getpid())
+        try:
+            shutil.copyfile(src, tmp)
+            os.rename(tmp, ent + '.iv')
+            f = open(tmp, 'w')
+            try:
+                json.dump(list(stats), f)
+            finally:
+                f.close()
+            os.rename(tmp, ent + '.json')
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.Evict()
+    def Evict(self):
+        # An entry's .iv and .json go together, as recently as either was used
+        ents = {}
+        total = 0
+        for name in os.listdir(self.path):
+            m = self.ENTRY.match(name)
+            if not m:
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            ent = ents.setdefault(m.group(1), [0, 0, []])
+            ent[0] = max(ent[0], st.st_mtime)
+            ent[1] += st.st_size
+            ent[2].append(name)
+            total += st.st_size
+        for mtime, size, names in sorted(ents.values()):
+            if total <= self.size:
+                break
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+            total -= size
+
+class PhaseProfiler(object):
+    '''Records the wall time, CPU time, peak RSS and (optionally) a count of
+    items processed for each phase of a conversion, optionally running one
+    named phase under cProfile.'''
+    def __init__(self, cprofile_phase=None, cprofile_fname=None):
+        self.phases = []
+        self.current = None
+        self.cprofile_phase = cprofile_phase
+        self.cprofile_fname = cprofile_fname
+        self.cprofile = None
+    @staticmethod
+    def Sample():
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        return time.time(), ru.ru_utime + ru.ru_stime, ru.ru_maxrss / 1024.0
+    def Phase(self, name):
+        self.End()
+        wall, cpu, rss = self.Sample()
+        self.current = {'phase': name, 'wall': wall, 'cpu': cpu, 'items': None}
+        if name == self.cprofile_phase:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+    def Items(self, count):
+        self.current['items'] = count
+    def End(self):
+        if self.current is None:
+            return
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            print 'cProfile of phase', self.current['phase'], '(written to', self.cprofile_fname, '):'
+            self.cprofile.dump_stats(self.cprofile_fname)
+            pstats.Stats(self.cprofile, stream=sys.stdout).sort_stats('cumulative').print_stats(25)
+            self.cprofile = None
+        wall, cpu, rss = self.Sample()
+        self.current['wall'] = wall - self.current['wall']
+        self.current['cpu'] = cpu - self.current['cpu']
+        self.current['peak_rss'] = rss
+        self.phases.append(self.current)
+        self.current = None
+    def Report(self):
+        print 'Phase       wall (s)    CPU (s)  peak RSS (MiB)      items'
+        for ph in self.phases:
+            print '%-10s %9.3f %10.3f %15.1f %10s'%(ph['phase'], ph['wall'], ph['cpu'], ph['peak_rss'], '-' if ph['items'] is None else ph['items'])
+        print '%-10s %9.3f %10.3f'%('total', sum(ph['wall'] for ph in self.phases), sum(ph['cpu'] for ph in self.phases))
+
+CHANNEL_EVENTS = dict((cls.statusmsg, cls) for cls in midi.EventRegistry.Events.itervalues() if cls.statusmsg < 0xF0)
+TEXT_METAS = set(cmd for cmd, cls in midi.EventRegistry.MetaEvents.iteritems() if issubclass(cls, midi.MetaEventWithText))
+
+# Names a -t condition may use and still only depend on the (tidx, channel,
+# bank, prog) of a note
+KEY_NAMES = frozenset(['ev', 'tidx', 'channel', 'bank', 'prog'])
+
+def is_key_filter(func):
+    '''Whether a group filter (a lambda) can only depend on the track,
+    channel, bank and program of a note, so that its result for one note
+    holds for every note sharing them.'''
+    code = func.func_code
+    return set(code.co_names) <= KEY_NAMES and not any(isinstance(const, type(code)) for const in code.co_consts)
+
+def midi_event(tick, status, data1, data2):
+    '''Builds the python-midi event for the fields of an smf event tuple,
+    with the given (relative) tick.'''
+    if status < 0xF0:
+        cls = CHANNEL_EVENTS[status & 0xF0]
+        ev = cls.__new__(cls)
+        ev.channel = status & 0x0F
+        ev.data = [data1, data2] if smf.DATA_BYTES[status & 0xF0] == 2 else [data1]
+    elif status == smf.META:
+        cls = midi.EventRegistry.MetaEvents.get(data1, midi.MetaEvent)
+        ev = cls.__new__(cls)
+        if cls is midi.MetaEvent:
+            ev.metacommand = data1
+        ev.data = map(ord, data2)
+        if data1 in TEXT_METAS:
+            ev.text = data2
+    else:
+        ev = midi.SysexEvent.__new__(midi.SysexEvent)
+        ev.channel = 0
+        ev.data = map(ord, data2[:-1] if data2.endswith('\xf7') else data2)
+    ev.tick = tick
+    return ev
+
+def pattern_to_smf(pat):
+    '''Converts a python-midi Pattern to an smf.MidiFile.'''
+    mf = smf.MidiFile(pat.format, pat.resolution)
+    for tidx, track in enumerate(pat):
+        events = []
+        abstick = 0
+        for ev in track:
+            abstick += ev.tick
+            if isinstance(ev, midi.MetaEvent):
+                events.append((abstick, tidx, smf.META, ev.metacommand, ''.join(map(chr, ev.data))))
+            elif isinstance(ev, midi.SysexEvent):
+                events.append((abstick, tidx, smf.SYSEX, 0, ''.join(map(chr, ev.data))))
+            else:
+                data = list(ev.data) + [0]
+                events.append((abstick, tidx, ev.statusmsg | ev.channel, data[0], data[1]))
+        mf.tracks.append(events)
+    return mf
+
+def convert(fname):
+    ivname = os.path.splitext(os.path.basename(fname))[0]+'.iv'
+    prof = PhaseProfiler(options.profile_phase, os.path.splitext(ivname)[0] + '.' + str(options.profile_phase) + '.prof')
+    key = None
+    if cache is not None:
+        try:
+            key = cache.Key(fname)
+        except IOError:
+            pass
+        else:
+            try:
+                result = cache.Fetch(key, fname, ivname)
+            except (IOError, OSError), e:
+                print 'WARNING: Could not read the conversion cache (%s); converting instead'%(e,)
+                result = None
+            if result is not None:
+                print fname, ': Unchanged since a cached conversion, wrote', ivname, 'from the cache'
+                return result
+    prof.Phase('read')
     try:
-        pat = midi.read_midifile(fname)
+        if options.fuckit:
+            pat = midi.read_midifile(fname)
+        else:
+            pat = smf.read(fname, options.streaming)
     except Exception:
         import traceback
         traceback.print_exc()
         print fname, ': Exception occurred, skipping...'
-        continue
+        return None
     if pat is None:
         print fname, ': Too fucked to continue'
-        continue
-    iv = ET.Element('iv')
-    iv.set('version', '1')
-    iv.set('src', os.path.basename(fname))
+        return None
+    if options.fuckit:
+        pat = pattern_to_smf(pat)
+    if not options.streaming:
+        prof.Items(sum(len(track) for track in pat))
     print fname, ': MIDI format,', len(pat), 'tracks'
     if options.verbose:
         print fname, ': MIDI Parameters:', pat.resolution, 'PPQN,', pat.format, 'format'
 
     if options.chansplit:
         print 'Splitting channels...'
+        prof.Phase('split')
         old_pat = pat
-        pat = midi.Pattern(resolution=old_pat.resolution)
+        pat = smf.MidiFile(1, old_pat.resolution)
         for track in old_pat:
             chan_map = {}
-            last_abstick = {}
-            absticks = 0
-            for ev in track:
-                absticks += ev.tick
-                if isinstance(ev, midi.Event):
-                    tick = absticks - last_abstick.get(ev.channel, 0)
-                    last_abstick[ev.channel] = absticks
-                    if options.chanskeep:
-                        newev = ev.copy(tick = tick)
-                    else:
-                        newev = ev.copy(channel=1, tick = tick)
-                    chan_map.setdefault(ev.channel, midi.Track()).append(newev)
-                else: # MetaEvent
+            for abstick, tidx, status, data1, data2 in track:
+                if status < 0xF0:
+                    chan = status & 0x0F
+                    if not options.chanskeep:
+                        status = (status & 0xF0) | 1
+                    chan_map.setdefault(chan, []).append((abstick, status, data1, data2))
+                else: # Meta/SysEx
                     for trk in chan_map.itervalues():
-                        trk.append(ev)
+                        trk.append((abstick, status, data1, data2))
             items = chan_map.items()
             items.sort(key=lambda pair: pair[0])
             for chn, trk in items:
-                pat.append(trk)
+                tidx = len(pat.tracks)
+                pat.tracks.append([(abstick, tidx, status, data1, data2) for abstick, status, data1, data2 in trk])
         print 'Split', len(old_pat), 'tracks into', len(pat), 'tracks by channel'
 
         if options.chansfname:
-            midi.write_midifile(options.chansfname, pat)
-
-##### Merge events from all tracks into one master list, annotated with track and absolute times #####
-    print 'Merging events...'
+            out = midi.Pattern(resolution=pat.resolution)
+            for track in pat:
+                trk = midi.Track()
+                lasttick = 0
+                for abstick, tidx, status, data1, data2 in track:
+                    trk.append(midi_event(abstick - lasttick, status, data1, data2))
+                    lasttick = abstick
+                out.append(trk)
+            midi.write_midifile(options.chansfname, out)
 
-    class SortEvent(object):
-        __slots__ = ['ev', 'tidx', 'abstick']
-        def __init__(self, ev, tidx, abstick):
-            self.ev = ev
-            self.tidx = tidx
-            self.abstick = abstick
-
-    sorted_events = []
-    for tidx, track in enumerate(pat):
-        absticks = 0
-        for ev in track:
-            absticks += ev.tick
-            sorted_events.append(SortEvent(ev, tidx, absticks))
+    print 'Computing tempos...'
+    prof.Phase('tempo')
 
-    sorted_events.sort(key=lambda x: x.abstick)
     if options.tempo == 'global':
         bpm_at = [{0: 120}]
     else:
         bpm_at = [{0: 120} for i in pat]
 
-    print 'Computing tempos...'
-
-    for sev in sorted_events:
-        if isinstance(sev.ev, midi.SetTempoEvent):
+    # Tracks are scanned in order, so a later track (or a later event in the
+    # same track) wins a tie on the same tick, exactly as in a merged order.
+    for abstick, tidx, status, data1, data2 in itertools.chain(*pat):
+        if status == smf.META and data1 == smf.META_TEMPO and len(data2) == 3:
+            mpqn = (ord(data2[0]) << 16) | (ord(data2[1]) << 8) | ord(data2[2])
+            if not mpqn:
+                continue
+            bpm = float(6e7) / mpqn
             if options.debug:
-                print fname, ': SetTempo at', sev.abstick, 'to', sev.ev.bpm, ':', sev.ev
-            bpm_at[sev.tidx if options.tempo == 'track' else 0][sev.abstick] = sev.ev.bpm
+                print fname, ': SetTempo at', abstick, 'to', bpm
+            bpm_at[tidx if options.tempo == 'track' else 0][abstick] = bpm
 
     if options.verbose:
-        print fname, ': Events:', len(sorted_events)
+        print fname, ': Events:', sum(len(track) for track in pat)
         print fname, ': Resolved global BPM:', bpm_at
         if options.debug:
             if options.tempo == 'track':
@@ -194,38 +515,42 @@ for fname in args:
                     print fname, ': Tempos in track', tidx
                     btimes = bpms.keys()
                     for i in range(len(btimes) - 1):
-                        fev = filter(lambda sev: sev.tidx == tidx and sev.abstick >= btimes[i] and sev.abstick < btimes[i+1], sorted_events)
+                        fev = filter(lambda sev: sev[0] >= btimes[i] and sev[0] < btimes[i+1], pat[tidx])
                         print fname, ': BPM partition', i, 'contains', len(fev), 'events'
             else:
                 btimes = bpm_at[0].keys()
                 for i in range(len(btimes) - 1):
-                    fev = filter(lambda sev: sev.abstick >= btimes[i] and sev.abstick < btimes[i+1], sorted_events)
+                    fev = filter(lambda sev: sev[0] >= btimes[i] and sev[0] < btimes[i+1], itertools.chain(*pat))
                     print fname, ': BPM partition', i, 'contains', len(fev), 'events'
 
-    def at2rt(abstick, bpms):
-        bpm_segs = bpms.items()
-        bpm_segs.sort(key=lambda pair: pair[0])
-        bpm_segs = filter(lambda pair: pair[0] <= abstick, bpm_segs)
-        rt = 0
-        atick = 0
-        if not bpm_segs:
+    class TempoMap(object):
+        __slots__ = ['ticks', 'bpms', 'times']
+        def __init__(self, bpms):
+            segs = sorted(bpms.items(), key=lambda pair: pair[0])
+            self.ticks = [tick for tick, bpm in segs]
+            self.bpms = [bpm for tick, bpm in segs]
+            self.times = []
             rt = 0
-        else:
-            ctick, bpm = bpm_segs[0]
-            rt = (60.0 * ctick) / (bpm * pat.resolution)
-        for idx in range(1, len(bpm_segs)):
-            dt = bpm_segs[idx][0] - bpm_segs[idx-1][0]
-            bpm = bpm_segs[idx-1][1]
-            rt += (60.0 * dt) / (bpm * pat.resolution)
-        if not bpm_segs:
-            bpm = 120
-            ctick = 0
-        else:
-            ctick, bpm = bpm_segs[-1]
-        if options.debug:
-            print 'seg through', bpm_segs, 'final seg', (abstick - ctick, bpm)
-        rt += (60.0 * (abstick - ctick)) / (bpm * pat.resolution)
-        return rt
+            for idx, (ctick, bpm) in enumerate(segs):
+                if idx == 0:
+                    rt = (60.0 * ctick) / (bpm * pat.resolution)
+                else:
+                    rt += (60.0 * (ctick - segs[idx-1][0])) / (segs[idx-1][1] * pat.resolution)
+                self.times.append(rt)
+        def RealTime(self, abstick):
+            idx = bisect.bisect_right(self.ticks, abstick) - 1
+            if idx < 0:
+                rt, ctick, bpm = 0, 0, 120
+            else:
+                rt, ctick, bpm = self.times[idx], self.ticks[idx], self.bpms[idx]
+            if options.debug:
+                print 'seg', idx, 'of', len(self.ticks), 'at', rt, 'final seg', (abstick - ctick, bpm)
+            return rt + (60.0 * (abstick - ctick)) / (bpm * pat.resolution)
+        def __iter__(self):
+            return iter(zip(self.ticks, self.bpms, self.times))
+
+    tempo_maps = [TempoMap(bpms) for bpms in bpm_at]
+    prof.Items(sum(len(tmap.ticks) for tmap in tempo_maps))
 
     class MergeEvent(object):
         __slots__ = ['ev', 'tidx', 'abstime', 'bank', 'prog', 'mw']
@@ -243,9 +568,29 @@ for fname in args:
         def __repr__(self):
             return '<ME %r in %d on (%d:%d) MW:%d @%f>'%(self.ev, self.tidx, self.bank, self.prog, self.mw, self.abstime)
 
-    vol_at = [[{0: 0x3FFF} for i in range(16)] for j in range(len(pat))]
+    class VolumeTimeline(object):
+        __slots__ = ['times', 'values']
+        def __init__(self, value=0x3FFF):
+            self.times = array.array('d', [0.0])
+            self.values = array.array('l', [value])
+        def Set(self, abstime, value):
+            if abstime > self.times[-1]:
+                self.times.append(abstime)
+                self.values.append(value)
+                return
+            idx = bisect.bisect_right(self.times, abstime)
+            if idx > 0 and self.times[idx-1] == abstime:
+                self.values[idx-1] = value
+            else:
+                self.times.insert(idx, abstime)
+                self.values.insert(idx, value)
+        def Last(self):
+            return self.values[-1]
+        def At(self, abstime):
+            return self.values[max(bisect.bisect_right(self.times, abstime) - 1, 0)]
+
+    vol_at = [[VolumeTimeline() for i in range(16)] for j in range(len(pat))]
 
-    events = []
     cur_mw = [[0 for i in range(16)] for j in range(len(pat))]
     cur_bank = [[0 for i in range(16)] for j in range(len(pat))]
     cur_prog = [[0 for i in range(16)] for j in range(len(pat))]
@@ -257,13 +602,20 @@ for fname in args:
     tnames = [''] * len(pat)
     progs = set([0])
 
-    for tidx, track in enumerate(pat):
+    def annotate_track(tidx, track):
+        # Yields (abstime, tidx, MergeEvent) in time order for one track,
+        # updating the per-track state above as it goes.
         abstime = 0
-        absticks = 0
-        lastbpm = 120
-        for ev in track:
-            absticks += ev.tick
-            abstime = at2rt(absticks, bpm_at[tidx if options.tempo == 'track' else 0])
+        lasttick = 0
+        for absticks, _, status, data1, data2 in track:
+            tick = absticks - lasttick
+            lasttick = absticks
+            # Meta events other than text never make it into a stream, so
+            # don't bother building them
+            if status == smf.META and data1 not in TEXT_METAS:
+                continue
+            ev = midi_event(tick, status, data1, data2)
+            abstime = tempo_maps[tidx if options.tempo == 'track' else 0].RealTime(absticks)
             if options.debug:
                 print 'tick', absticks, 'realtime', abstime
             if isinstance(ev, midi.TrackNameEvent):
@@ -286,55 +638,385 @@ for fname in args:
                     cur_mw[tidx][ev.channel] = (0x3F80 & cur_mw[tidx][ev.channel]) | ev.value
                     chg_mw[tidx][ev.channel] += 1
                 elif ev.control == 7:  # Volume -- MSB
-                    lvtime, lvol = sorted(vol_at[tidx][ev.channel].items(), key = lambda pair: pair[0])[-1]
-                    vol_at[tidx][ev.channel][abstime] = (0x3F & lvol) | (ev.value << 7)
+                    lvol = vol_at[tidx][ev.channel].Last()
+                    vol_at[tidx][ev.channel].Set(abstime, (0x3F & lvol) | (ev.value << 7))
                     chg_vol[tidx][ev.channel] += 1
                 elif ev.control == 39:  # Volume -- LSB
-                    lvtime, lvol = sorted(vol_at[tidx][ev.channel].items(), key = lambda pair: pair[0])[-1]
-                    vol_at[tidx][ev.channel][abstime] = (0x3F80 & lvol) | ev.value
+                    lvol = vol_at[tidx][ev.channel].Last()
+                    vol_at[tidx][ev.channel].Set(abstime, (0x3F80 & lvol) | ev.value)
                     chg_vol[tidx][ev.channel] += 1
-                events.append(MergeEvent(ev, tidx, abstime, cur_bank[tidx][ev.channel], cur_prog[tidx][ev.channel], cur_mw[tidx][ev.channel]))
+                yield abstime, tidx, MergeEvent(ev, tidx, abstime, cur_bank[tidx][ev.channel], cur_prog[tidx][ev.channel], cur_mw[tidx][ev.channel])
                 ev_cnts[tidx][ev.channel] += 1
             elif isinstance(ev, midi.MetaEventWithText):
-                events.append(MergeEvent(ev, tidx, abstime))
+                yield abstime, tidx, MergeEvent(ev, tidx, abstime)
             elif isinstance(ev, midi.Event):
                 if isinstance(ev, midi.NoteOnEvent) and ev.velocity == 0:
                     ev.__class__ = midi.NoteOffEvent #XXX Oww
-                events.append(MergeEvent(ev, tidx, abstime, cur_bank[tidx][ev.channel], cur_prog[tidx][ev.channel], cur_mw[tidx][ev.channel]))
+                yield abstime, tidx, MergeEvent(ev, tidx, abstime, cur_bank[tidx][ev.channel], cur_prog[tidx][ev.channel], cur_mw[tidx][ev.channel])
                 ev_cnts[tidx][ev.channel] += 1
 
-    print 'Track name, event count, final banks, bank changes, final programs, program changes, final modwheel, modwheel changes, volume changes:'
-    for tidx, tname in enumerate(tnames):
-        print tidx, ':', tname, ',', ','.join(map(str, ev_cnts[tidx])), ',', ','.join(map(str, cur_bank[tidx])), ',', ','.join(map(str, chg_bank[tidx])), ',', ','.join(map(str, cur_prog[tidx])), ',', ','.join(map(str, chg_prog[tidx])), ',', ','.join(map(str, cur_mw[tidx])), ',', ','.join(map(str, chg_mw[tidx])), ',', ','.join(map(str, chg_vol[tidx]))
-    print 'All programs observed:', progs
-
-    print 'Sorting events...'
-
-    events.sort(key = lambda ev: ev.abstime)
-
 ##### Use merged events to construct a set of streams with non-overlapping durations #####
     print 'Generating streams...'
+    prof.Phase('streams')
+
+    class NoteHistory(object):
+        '''The notes of a stream, stored as parallel arrays (one column per
+        attribute) rather than as an object per note.'''
+        COLUMNS = (('abstime', 'd'), ('duration', 'd'), ('real_duration', 'd'), ('pitch', 'd'), ('ampl', 'd'), ('bent', 'B'), ('modwheel', 'H'), ('tidx', 'I'), ('channel', 'B'), ('note', 'B'), ('velocity', 'B'), ('bank', 'H'), ('prog', 'B'), ('mw', 'H'))
+        # Columns which notes derived from another (by the modwheel or string
+        # model) inherit from it
+        INHERITED = ('modwheel', 'tidx', 'channel', 'note', 'velocity', 'bank', 'prog', 'mw')
+        DTYPES = {'d': numpy.float64, 'B': numpy.uint8, 'H': numpy.uint16, 'I': numpy.uint32}
+        __slots__ = ['abstime', 'duration', 'real_duration', 'pitch', 'ampl', 'bent', 'modwheel', 'tidx', 'channel', 'note', 'velocity', 'bank', 'prog', 'mw']
+        def __init__(self):
+            for name, code in self.COLUMNS:
+                setattr(self, name, array.array(code))
+        def __len__(self):
+            return len(self.abstime)
+        def Add(self, mev, pitch, ampl, dur, modwheel=0):
+            self.abstime.append(mev.abstime)
+            self.duration.append(dur)
+            self.real_duration.append(dur)
+            self.pitch.append(pitch)
+            self.ampl.append(ampl)
+            self.bent.append(not isinstance(pitch, (int, long)))
+            self.modwheel.append(modwheel)
+            self.tidx.append(mev.tidx)
+            self.channel.append(mev.ev.channel)
+            self.note.append(mev.ev.pitch)
+            self.velocity.append(mev.ev.velocity)
+            self.bank.append(mev.bank)
+            self.prog.append(mev.prog)
+            self.mw.append(mev.mw)
+        def Expand(self, src, i, times, pitches, ampls, durs, bent):
+            # Appends notes derived from note i of src
+            self.abstime.extend(times)
+            self.duration.extend(durs)
+            self.real_duration.extend(durs)
+            self.pitch.extend(pitches)
+            self.ampl.extend(ampls)
+            self.bent.extend([bent] * len(times))
+            for name in self.INHERITED:
+                getattr(self, name).extend([getattr(src, name)[i]] * len(times))
+        def Extend(self, src, lo=0, hi=None):
+            # Appends notes lo through hi (exclusive) of src
+            for name, code in self.COLUMNS:
+                getattr(self, name).extend(getattr(src, name)[lo:hi])
+        def Compress(self, keep):
+            # Keeps only the notes for which keep (a sequence of booleans) is true
+            keep = numpy.asarray(keep, bool)
+            for name, code in self.COLUMNS:
+                col = array.array(code)
+                col.fromstring(self.Column(name)[keep].tostring())
+                setattr(self, name, col)
+        def Column(self, name):
+            # A NumPy view of a column; it is only valid until the column is
+            # next resized.
+            col = getattr(self, name)
+            if not col:
+                return numpy.zeros(0, self.DTYPES[col.typecode])
+            return numpy.frombuffer(col, self.DTYPES[col.typecode])
+        def Pitch(self, i):
+            # Unbent pitches stay integers, so they print as such
+            return self.pitch[i] if self.bent[i] else int(self.pitch[i])
+        def Row(self, i):
+            return NoteView(self, i)
+        def Key(self, i):
+            return (self.tidx[i], self.channel[i], self.bank[i], self.prog[i])
+        def Tags(self):
+            for abstime, dur, pitch, bent, ampl in itertools.izip(self.abstime, self.real_duration, self.pitch, self.bent, self.ampl):
+                yield IVWriter.NoteTag(ampl, dur, pitch if bent else int(pitch), abstime)
+
+    class NoteView(object):
+        '''One note of a NoteHistory, with the attributes of a MergeEvent (so
+        that group filters and diagnostics can be used on it).'''
+        __slots__ = ['history', 'index']
+        def __init__(self, history, index):
+            self.history = history
+            self.index = index
+        def __getattr__(self, name):
+            hist, i = self.history, self.index
+            if name == 'ev':
+                return midi_event(0, 0x90 | hist.channel[i], hist.note[i], hist.velocity[i])
+            if name == 'pitch':
+                return hist.Pitch(i)
+            if name in NoteHistory.__slots__:
+                return getattr(hist, name)[i]
+            raise AttributeError(name)
+        def __repr__(self):
+            return '<NE <ME %r in %d on (%d:%d) MW:%d @%f> P:%f A:%f D:%f W:%f>'%(self.ev, self.tidx, self.bank, self.prog, self.mw, self.abstime, self.pitch, self.ampl, self.duration, self.modwheel)
+
+    def step_offsets(start, step, count):
+        # Same values as repeatedly doing "dt += step" from start
+        return numpy.add.accumulate(numpy.append(start, numpy.repeat(step, count - 1)))
+
+    rate_stats = collections.Counter()
+
+    class RateWindow(object):
+        '''The times of the events a stream has played in the last second and
+        (if known) when its notes start, so that limit_rate can hold it to
+        options.maxrate across its notes.'''
+        __slots__ = ['times', 'onsets']
+        def __init__(self, onsets=()):
+            self.times = collections.deque()
+            self.onsets = onsets  # Sorted
+        def Trim(self, abstime):
+            # Forgets the events that started a second or more before abstime
+            times = self.times
+            while times and times[0] <= abstime - 1.0:
+                times.popleft()
+        def Room(self, abstime):
+            # How many more events may start at abstime, keeping room for the
+            # notes that start within the next second
+            self.Trim(abstime)
+            ahead = bisect.bisect_left(self.onsets, abstime + 1.0) - bisect.bisect_right(self.onsets, abstime)
+            return max(1, int(options.maxrate)) - len(self.times) - ahead
+        def Add(self, abstime):
+            self.Trim(abstime)
+            self.times.append(abstime)
+        def Extend(self, abstimes):
+            if abstimes:
+                self.times.extend(abstimes)
+                self.Trim(abstimes[-1])
+
+    def limit_rate(times, pitches, ampls, durs, window):
+        # Thins contiguous steps (as NumPy arrays) of a modwheel or string
+        # model expansion so that the stream whose RateWindow is window plays
+        # at most options.maxrate events in any second, each kept step lasting
+        # until the next one starts. The first step (the note itself) is
+        # always kept.
+        n = len(times)
+        if options.maxrate <= 0 or n < 1:
+            return times, pitches, ampls, durs
+        ends = times + durs
+        tlist, plist, alist = times.tolist(), pitches.tolist(), ampls.tolist()
+        spacing = 1.0 / options.maxrate
+        keep = [0]
+        window.Add(tlist[0])
+        for j in xrange(1, n):
+            k = keep[-1]
+            # Merge steps into the last kept one while they sound the same or
+            # come too soon after it, or the stream has played enough lately
+            if abs(plist[j] - plist[k]) * 100.0 <= options.ratecents and abs(alist[j] - alist[k]) <= options.rateampl * alist[k]:
+                continue
+            if tlist[j] - tlist[k] < spacing or window.Room(tlist[j]) <= 0:
+                continue
+            keep.append(j)
+            window.Add(tlist[j])
+        if len(keep) == n:
+            return times, pitches, ampls, durs
+        rate_stats['thinned'] += n - len(keep)
+        keep = numpy.array(keep)
+        last = numpy.append(keep[1:], n) - 1  # Last step merged into each kept one
+        return times[keep], pitches[keep], ampls[keep], ends[last] - times[keep]
+
+    def modwheel_notes(src, i, dst, window):
+        # Appends the notes that note i of src (which has a nonzero modwheel)
+        # resolves to onto dst, returning how many there were; window is the
+        # RateWindow of their stream
+        abstime, duration, pitch, ampl = src.abstime[i], src.duration[i], src.Pitch(i), src.ampl[i]
+        mwamp = float(src.modwheel[i]) / 0x3FFF
+        count = int(duration / options.modres) + 2
+        dts = step_offsets(0.0, options.modres, count)
+        while dts[-1] < duration:
+            count *= 2
+            dts = step_offsets(0.0, options.modres, count)
+        dts = dts[:numpy.searchsorted(dts, duration)]
+        if options.modcont:
+            t = numpy.repeat(abstime, len(dts))
+        else:
+            t = dts
+        pitches = pitch + mwamp * options.modfdev * numpy.sin(2 * math.pi * options.modffreq * t)
+        ampls = ampl + mwamp * options.modadev * (numpy.sin(2 * math.pi * options.modafreq * t) - 1.0) / 2.0
+        durs = numpy.minimum(options.modres, duration - dts)
+        times, pitches, ampls, durs = limit_rate(abstime + dts, pitches, ampls, durs, window)
+        dst.Expand(src, i, times.tolist(), pitches.tolist(), ampls.tolist(), durs.tolist(), True)
+        return len(times)
+
+    def resolve_volume(hist, lo=0, hi=None):
+        # Scales the amplitude of notes lo through hi (exclusive) of hist by
+        # their channel volume
+        if hi is None:
+            hi = len(hist)
+        if hi - lo < 16:
+            # Not worth NumPy's overhead (as when streaming, note by note)
+            for i in xrange(lo, hi):
+                vol = vol_at[hist.tidx[i]][hist.channel[i]].At(hist.abstime[i])
+                hist.ampl[i] *= (float(vol) / 0x3FFF) ** options.vol_pow
+            return
+        abstimes = hist.Column('abstime')[lo:hi]
+        ampls = hist.Column('ampl')[lo:hi]
+        keys = hist.Column('tidx')[lo:hi].astype(numpy.int64) * 16 + hist.Column('channel')[lo:hi]
+        for key in numpy.unique(keys).tolist():
+            tl = vol_at[key // 16][key % 16]
+            sel = numpy.flatnonzero(keys == key)
+            idx = numpy.maximum(numpy.searchsorted(numpy.frombuffer(tl.times, numpy.float64), abstimes[sel], 'right') - 1, 0)
+            vols, inv = numpy.unique(numpy.frombuffer(tl.values, numpy.int_)[idx], return_inverse=True)
+            # Python's ** per distinct volume, to round as the scalar path does
+            ampls[sel] *= numpy.array([(float(vol) / 0x3FFF) ** options.vol_pow for vol in vols.tolist()])[inv]
+
+    def check_pair(i, abstime, duration, next_abstime):
+        # Prints warnings about note i (at abstime for duration) and the note
+        # after it in a stream, returning how many there were
+        ecnt = 0
+        if abstime + duration > next_abstime + options.epsilon:
+            print 'WARNING: event', i, 'collides with next event (@', abstime, '+', duration, 'next @', next_abstime, ';', next_abstime - (abstime + duration), 'overlap)'
+            ecnt += 1
+        if abstime > next_abstime:
+            print 'WARNING: event', i + 1, 'out of sort order (@', abstime, 'next @', next_abstime, ';', abstime - next_abstime, 'underlap)'
+            ecnt += 1
+        return ecnt
+
+    def text_attrs(tev):
+        text = tev.ev.text
+        try:
+            text = text.decode('utf8')
+        except UnicodeDecodeError:
+            text = 'base64:' + text.encode('base64')
+        return {'time': str(tev.abstime), 'type': type(tev.ev).__name__, 'text': text}
 
-    class DurationEvent(MergeEvent):
-        __slots__ = ['duration', 'real_duration', 'pitch', 'modwheel', 'ampl']
-        def __init__(self, me, pitch, ampl, dur, modwheel=0):
-            MergeEvent.__init__(self, me.ev, me.tidx, me.abstime, me.bank, me.prog, me.mw)
-            self.pitch = pitch
-            self.ampl = ampl
-            self.duration = dur
-            self.real_duration = dur
-            self.modwheel = modwheel
+    fw = midi.FileWriter()
+    fw.RunningStatus = None # XXX Hack
 
-        def __repr__(self):
-            return '<NE %s P:%f A:%f D:%f W:%f>'%(MergeEvent.__repr__(self), self.pitch, self.ampl, self.duration, self.modwheel)
+    def aux_attrs(mev):
+        # Must be called on the aux events in order (fw tracks running status)
+        return {'time': str(mev.abstime), 'data': repr(fw.encode_midi_event(mev.ev))}
+
+    class Spiller(object):
+        '''Finishes notes soon after their streams release them (modwheel,
+        culling, volume and consistency checks) and appends their XML to a
+        temporary file per stream, along with the text and aux streams.'''
+        __slots__ = ['path', 'buffers', 'sizes', 'counts', 'keys', 'last', 'windows', 'notes', 'pending', 'resolved', 'culled', 'errors']
+        FLUSH_SIZE = 16384
+        RECYCLE_SIZE = 4096
+        FINISH_BATCH = 256  # Released ranges to finish at once
+        def __init__(self):
+            self.path = tempfile.mkdtemp(prefix='mkiv-')
+            self.buffers = {}  # key -> [str]
+            self.sizes = {}  # key -> bytes buffered
+            self.counts = {}  # key -> elements written
+            self.keys = {}  # NoteStream -> key
+            self.last = {}  # NoteStream -> (abstime, duration) of the last note written
+            self.windows = collections.defaultdict(RateWindow)  # NoteStream -> RateWindow, for --max-rate
+            self.notes = NoteHistory()  # Released notes, until finished
+            self.pending = collections.deque()  # (latest abstime, NoteStream, lo, hi) ranges of self.notes
+            self.resolved = 0
+            self.culled = 0
+            self.errors = 0
+        @staticmethod
+        def Key(ns):
+            return 'ns%d_%d'%(ns.group.rank, ns.index)
+        def Write(self, key, data):
+            self.buffers.setdefault(key, []).append(data)
+            self.sizes[key] = self.sizes.get(key, 0) + len(data)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if self.sizes[key] >= self.FLUSH_SIZE:
+                self.Flush(key)
+        def WriteAll(self, key, datas):
+            self.buffers.setdefault(key, []).extend(datas)
+            self.sizes[key] = self.sizes.get(key, 0) + sum(itertools.imap(len, datas))
+            self.counts[key] = self.counts.get(key, 0) + len(datas)
+            if self.sizes[key] >= self.FLUSH_SIZE:
+                self.Flush(key)
+        def Flush(self, key):
+            f = open(os.path.join(self.path, key), 'ab')
+            f.write(''.join(self.buffers[key]))
+            f.close()
+            del self.buffers[key][:]
+            self.sizes[key] = 0
+        def Count(self, key):
+            return self.counts.get(key, 0)
+        def Note(self, ns):
+            # ns just released the last note in self.notes
+            notes = self.notes
+            i = len(notes) - 1
+            if options.modres > 0 and notes.modwheel[i] > 0:
+                cnt = modwheel_notes(notes, i, notes, self.windows[ns])
+                self.resolved += cnt
+                self.pending.append((max(notes.abstime[i + 1:] or notes.abstime[i:]), ns, i + 1, i + 1 + cnt))
+            else:
+                if options.maxrate > 0:
+                    self.windows[ns].Add(notes.abstime[i])
+                self.pending.append((notes.abstime[i], ns, i, i + 1))
+        def Advance(self, abstime):
+            # Every event up to (but maybe not including) abstime has been
+            # merged, so the volume of anything before it is now settled.
+            # Ranges wait until there are enough of them to finish together.
+            pending = self.pending
+            if len(pending) < self.FINISH_BATCH:
+                return
+            due = []
+            while pending and pending[0][0] < abstime:
+                due.append(pending.popleft())
+            if due:
+                self.Finish(due)
+            if not pending and len(self.notes) >= self.RECYCLE_SIZE:
+                self.notes = NoteHistory()
+        def Drain(self):
+            if self.pending:
+                self.Finish(list(self.pending))
+                self.pending.clear()
+        def Finish(self, due):
+            # due are pending ranges, in order, and so cover notes[lo:hi]
+            # (save for the sources of modwheel notes, which are never written)
+            notes = self.notes
+            resolve_volume(notes, due[0][2], due[-1][3])
+            cols = (notes.abstime, notes.duration, notes.real_duration, notes.pitch, notes.bent, notes.ampl)
+            keepempty, epsilon, note_tag = options.keepempty, options.epsilon, IVWriter.NoteTag
+            out = collections.OrderedDict()  # key -> tags, written once all are done
+            for _, ns, lo, hi in due:
+                key = self.keys.get(ns)
+                if key is None:
+                    key = self.keys[ns] = self.Key(ns)
+                last_t, last_d = self.last.get(ns, (None, None))
+                count = self.Count(key)
+                tags = out.setdefault(key, [])
+                for abstime, duration, real_duration, pitch, bent, ampl in itertools.izip(*[col[lo:hi] for col in cols]):
+                    if duration == 0.0 and not keepempty:
+                        self.culled += 1
+                        continue
+                    if last_t is not None and (last_t + last_d > abstime + epsilon or last_t > abstime):
+                        self.errors += check_pair(count + len(tags) - 1, last_t, last_d, abstime)
+                    last_t, last_d = abstime, duration
+                    tags.append(note_tag(ampl, real_duration, pitch if bent else int(pitch), abstime))
+                if last_t is not None:
+                    self.last[ns] = (last_t, last_d)
+            for key, tags in out.iteritems():
+                if tags:
+                    self.WriteAll(key, tags)
+        def Text(self, tev):
+            self.Write('text', IVWriter.EmptyTag('text', text_attrs(tev)))
+        def Aux(self, mev):
+            self.Write('aux', IVWriter.EmptyTag('ev', aux_attrs(mev)))
+        def CopyTo(self, key, f):
+            if self.buffers.get(key):
+                self.Flush(key)
+            path = os.path.join(self.path, key)
+            if os.path.exists(path):
+                spill = open(path, 'rb')
+                shutil.copyfileobj(spill, f)
+                spill.close()
+                os.remove(path)
+        def Close(self):
+            shutil.rmtree(self.path, True)
+
+    spiller = Spiller() if options.streaming else None
+
+    active_notes = {}  # (tidx, channel, pitch) -> [NoteStream]
+    active_chans = {}  # (tidx, channel) -> [NoteStream]
 
     class NoteStream(object):
-        __slots__ = ['history', 'active', 'bentpitch', 'modwheel']
-        def __init__(self):
-            self.history = []
+        __slots__ = ['history', 'active', 'bentpitch', 'modwheel', 'group', 'index', 'pooled']
+        def __init__(self, group=None, index=None):
+            self.history = NoteHistory()
             self.active = None
             self.bentpitch = None
             self.modwheel = 0
+            self.group = group
+            self.index = index
+            self.pooled = False
+        def Rank(self):
+            return (self.group.rank, self.index)
         def IsActive(self):
             return self.active is not None
         def Activate(self, mev, bentpitch=None, modwheel=None):
@@ -344,45 +1026,86 @@ for fname in args:
             self.bentpitch = bentpitch
             if modwheel is not None:
                 self.modwheel = modwheel
+            active_notes.setdefault((mev.tidx, mev.ev.channel, mev.ev.pitch), []).append(self)
+            active_chans.setdefault((mev.tidx, mev.ev.channel), []).append(self)
         def Deactivate(self, mev):
-            self.history.append(DurationEvent(self.active, self.bentpitch, self.active.ev.velocity / 127.0, mev.abstime - self.active.abstime, self.modwheel))
+            hist = self.history if spiller is None else spiller.notes
+            hist.Add(self.active, self.bentpitch, self.active.ev.velocity / 127.0, mev.abstime - self.active.abstime, self.modwheel)
+            if spiller is not None:
+                spiller.Note(self)
+            active_notes[self.active.tidx, self.active.ev.channel, self.active.ev.pitch].remove(self)
+            active_chans[self.active.tidx, self.active.ev.channel].remove(self)
             self.active = None
             self.bentpitch = None
             self.modwheel = 0
-        def WouldDeactivate(self, mev):
-            if not self.IsActive():
-                return False
-            if isinstance(mev.ev, midi.NoteOffEvent):
-                return mev.ev.pitch == self.active.ev.pitch and mev.tidx == self.active.tidx and mev.ev.channel == self.active.ev.channel
-            if isinstance(mev.ev, midi.PitchWheelEvent):
-                return mev.tidx == self.active.tidx and mev.ev.channel == self.active.ev.channel
-            if isinstance(mev.ev, midi.ControlChangeEvent):
-                return mev.tidx == self.active.tidx and mev.ev.channel == self.active.ev.channel
-            raise TypeError('Tried to deactivate with bad type %r'%(type(mev.ev),))
+            # Streams reactivated in place (pitch bends, modwheel) stay in the
+            # pool; NSGroup.Assign skips them if they are still active.
+            if self.group is not None and not self.pooled:
+                heapq.heappush(self.group.idle, self.index)
+                self.pooled = True
 
     class NSGroup(object):
-        __slots__ = ['streams', 'filter', 'name']
+        __slots__ = ['streams', 'filter', 'keyed', 'name', 'rank', 'idle']
+        ranks = itertools.count()
         def __init__(self, filter=None, name=None):
             self.streams = []
             self.filter = (lambda mev: True) if filter is None else filter
+            self.keyed = filter is None or is_key_filter(filter)
             self.name = name
-        def Accept(self, mev):
-            if not self.filter(mev):
-                return False
-            for stream in self.streams:
+            self.rank = NSGroup.ranks.next()
+            self.idle = []  # min-heap of stream indices
+        def Assign(self, mev):
+            while self.idle:
+                stream = self.streams[heapq.heappop(self.idle)]
+                stream.pooled = False
                 if not stream.IsActive():
                     stream.Activate(mev)
-                    break
-            else:
-                stream = NoteStream()
-                self.streams.append(stream)
-                stream.Activate(mev)
-            return True
+                    return
+            stream = NoteStream(self, len(self.streams))
+            self.streams.append(stream)
+            stream.Activate(mev)
+
+    class GroupDispatcher(object):
+        '''Finds the first of the groups whose filter accepts a note. Filters
+        that only depend on the note's key--(tidx, channel, bank, prog)--are
+        evaluated once per key; the others on every note, in order.'''
+        __slots__ = ['groups', 'count', 'memo']
+        def __init__(self, groups):
+            self.groups = groups
+            self.count = len(groups)
+            self.memo = {}  # key -> [NSGroup] that may accept it, in order
+        def Find(self, key, mev):
+            if len(self.groups) != self.count:
+                self.count = len(self.groups)
+                self.memo.clear()
+            cands = self.memo.get(key)
+            if cands is None:
+                cands = []
+                for group in self.groups:
+                    if not group.keyed:
+                        cands.append(group)
+                    elif group.filter(mev):
+                        cands.append(group)
+                        break  # Later groups can never be reached
+                self.memo[key] = cands
+            for group in cands:
+                if group.keyed or group.filter(mev):
+                    return group
+            return None
 
     notegroups = []
     auxstream = []
     textstream = []
 
+    # Each track is already in time order, so a k-way merge of the lazily
+    # annotated tracks yields every event in time order (ties going to the
+    # lower track) without building and sorting a list of them.
+    annotated = [annotate_track(tidx, track) for tidx, track in enumerate(pat)]
+    if PROGRAMS in options.tracks:
+        # Program groups need every program in the file up front
+        annotated = [list(evs) for evs in annotated]
+    events = heapq.merge(*annotated)
+
     if options.perc and options.perc != 'none':
         if options.perc == 'GM':
             notegroups.append(NSGroup(filter = lambda mev: mev.ev.channel == 9, name='perc'))
@@ -408,29 +1131,30 @@ for fname in args:
     if options.verbose:
         print 'Initial group mappings:'
         for group in notegroups:
-            print ('<anonymous>' if group.name is None else group.name)
+            print ('<anonymous>' if group.name is None else group.name) + (' (by key)' if group.keyed else '')
+
+    dispatch = GroupDispatcher(notegroups)
 
-    for mev in events:
+    bends_coalesced = 0
+    mev = None
+    for _, _, mev in events:
+        if spiller is not None:
+            spiller.Advance(mev.abstime)
         if isinstance(mev.ev, midi.MetaEventWithText):
-            textstream.append(mev)
+            if spiller is None:
+                textstream.append(mev)
+            elif not options.no_text:
+                spiller.Text(mev)
         elif isinstance(mev.ev, midi.NoteOnEvent):
-            for group in notegroups:
-                if group.Accept(mev):
-                    break
-            else:
+            group = dispatch.Find((mev.tidx, mev.ev.channel, mev.bank, mev.prog), mev)
+            if group is None:
                 group = NSGroup()
-                group.Accept(mev)
                 notegroups.append(group)
+            group.Assign(mev)
         elif isinstance(mev.ev, midi.NoteOffEvent):
-            for group in notegroups:
-                found = False
-                for stream in group.streams:
-                    if stream.WouldDeactivate(mev):
-                        stream.Deactivate(mev)
-                        found = True
-                        break
-                if found:
-                    break
+            streams = active_notes.get((mev.tidx, mev.ev.channel, mev.ev.pitch))
+            if streams:
+                min(streams, key=NoteStream.Rank).Deactivate(mev)
             else:
                 print 'WARNING: Did not match %r with any stream deactivation.'%(mev,)
                 if options.verbose:
@@ -440,15 +1164,20 @@ for fname in args:
                         for stream in group.streams:
                             print '      Stream: %r'%(stream.active,)
         elif options.deviation > 0 and isinstance(mev.ev, midi.PitchWheelEvent):
-            found = False
-            for group in notegroups:
-                for stream in group.streams:
-                    if stream.WouldDeactivate(mev):
-                        base = stream.active.copy(abstime=mev.abstime)
-                        stream.Deactivate(mev)
-                        stream.Activate(base, base.ev.pitch + options.deviation * (mev.ev.pitch / float(0x2000)))
-                        found = True
-            if not found:
+            streams = active_chans.get((mev.tidx, mev.ev.channel))
+            for stream in list(streams or ()):
+                bentpitch = stream.active.ev.pitch + options.deviation * (mev.ev.pitch / float(0x2000))
+                if abs(bentpitch - stream.bentpitch) * 100.0 < options.bendcents:
+                    bends_coalesced += 1
+                    continue
+                if mev.abstime - stream.active.abstime < options.bendquantum:
+                    stream.bentpitch = bentpitch
+                    bends_coalesced += 1
+                    continue
+                base = stream.active.copy(abstime=mev.abstime)
+                stream.Deactivate(mev)
+                stream.Activate(base, bentpitch)
+            if not streams:
                 print 'WARNING: Did not find any matching active streams for %r'%(mev,)
                 if options.verbose:
                     print '  Current state:'
@@ -457,15 +1186,12 @@ for fname in args:
                         for stream in group.streams:
                             print '      Stream: %r'%(stream.active,)
         elif options.modres > 0 and isinstance(mev.ev, midi.ControlChangeEvent):
-            found = False
-            for group in notegroups:
-                for stream in group.streams:
-                    if stream.WouldDeactivate(mev):
-                        base = stream.active.copy(abstime=mev.abstime)
-                        stream.Deactivate(mev)
-                        stream.Activate(base, stream.bentpitch, mev.mw)
-                        found = True
-            if not found:
+            streams = active_chans.get((mev.tidx, mev.ev.channel))
+            for stream in list(streams or ()):
+                base = stream.active.copy(abstime=mev.abstime)
+                stream.Deactivate(mev)
+                stream.Activate(base, stream.bentpitch, mev.mw)
+            if not streams:
                 print 'WARNING: Did not find any matching active streams for %r'%(mev,)
                 if options.verbose:
                     print '  Current state:'
@@ -473,183 +1199,220 @@ for fname in args:
                         print '    Group %r:'%(group.name,)
                         for stream in group.streams:
                             print '      Stream: %r'%(stream.active,)
-        else:
+        elif spiller is None:
             auxstream.append(mev)
+        else:
+            spiller.Aux(mev)
 
-    lastabstime = events[-1].abstime
+    lastabstime = 0.0 if mev is None else mev.abstime
+    if options.bendcents > 0 or options.bendquantum > 0:
+        print 'Coalesced', bends_coalesced, 'pitchbend splits'
 
+    print 'Track name, event count, final banks, bank changes, final programs, program changes, final modwheel, modwheel changes, volume changes:'
+    for tidx, tname in enumerate(tnames):
+        print tidx, ':', tname, ',', ','.join(map(str, ev_cnts[tidx])), ',', ','.join(map(str, cur_bank[tidx])), ',', ','.join(map(str, chg_bank[tidx])), ',', ','.join(map(str, cur_prog[tidx])), ',', ','.join(map(str, chg_prog[tidx])), ',', ','.join(map(str, cur_mw[tidx])), ',', ','.join(map(str, chg_mw[tidx])), ',', ','.join(map(str, chg_vol[tidx]))
+    print 'All programs observed:', progs
     for group in notegroups:
         for ns in group.streams:
             if ns.IsActive():
                 print 'WARNING: Active notes at end of playback.'
                 ns.Deactivate(MergeEvent(ns.active, ns.active.tidx, lastabstime))
 
+    if spiller is not None:
+        spiller.Drain()
+
+    def note_count(ns):
+        if spiller is None:
+            return len(ns.history)
+        return spiller.Count(Spiller.Key(ns))
+
+    prof.Items(sum(note_count(ns) for group in notegroups for ns in group.streams))
+
+    if spiller is not None:
+        print 'Resolved', spiller.resolved, 'modwheel events and culled', spiller.culled, 'events while streaming;', spiller.errors, 'consistency warnings'
+
+    def pack_streams(group, items, notes, tolerance=0.0):
+        # items are (start, end, lo, hi) sorted by start, covering notes lo
+        # through hi (exclusive) of the NoteHistory notes; each goes
+        # into the lowest-indexed stream that has ended by its start, which is
+        # first-fit and yields the minimal stream count for sorted intervals.
+        group.streams = []
+        busy = []  # heap of (end, stream index)
+        free = []  # heap of stream indices
+        for start, end, lo, hi in items:
+            while busy and busy[0][0] - tolerance <= start:
+                heapq.heappush(free, heapq.heappop(busy)[1])
+            if free:
+                ns = group.streams[heapq.heappop(free)]
+            else:
+                ns = NoteStream(group, len(group.streams))
+                group.streams.append(ns)
+            ns.history.Extend(notes, lo, hi)
+            heapq.heappush(busy, (end, ns.index))
+        if options.verbose:
+            print 'Packed', len(items), 'intervals of group', ('<anonymous>' if group.name is None else group.name), 'into', len(group.streams), 'streams'
+
     if options.slack > 0:
         print 'Adding slack time...'
+        prof.Phase('slack')
 
-        slack_evs = []
+        slack_notes = NoteHistory()
         for group in notegroups:
             for ns in group.streams:
-                for dev in ns.history:
-                    dev.duration += options.slack
-                    slack_evs.append(dev)
+                slack_notes.Extend(ns.history)
+        durs = slack_notes.Column('duration')
+        durs += options.slack
 
         print 'Resorting all streams...'
-        for group in notegroups:
-            group.streams = []
+        group_items = dict((group, []) for group in notegroups)
 
-        for dev in slack_evs:
-            for group in notegroups:
-                if not group.filter(dev):
-                    continue
-                for ns in group.streams:
-                    if dev.abstime >= ns.history[-1].abstime + ns.history[-1].duration:
-                        ns.history.append(dev)
-                        break
-                else:
-                    group.streams.append(NoteStream())
-                    group.streams[-1].history.append(dev)
-                break
+        for i in numpy.argsort(slack_notes.Column('abstime'), kind='mergesort').tolist():
+            dev = slack_notes.Row(i)
+            group = dispatch.Find(slack_notes.Key(i), dev)
+            if group is not None:
+                group_items[group].append((dev.abstime, dev.abstime + dev.duration, i, i + 1))
             else:
                 print 'WARNING: No stream accepts event', dev
 
-    if options.modres > 0:
+        for group in notegroups:
+            pack_streams(group, group_items[group], slack_notes)
+        prof.Items(len(slack_notes))
+
+    if options.modres > 0 and spiller is None:
         print 'Resolving modwheel events...'
+        prof.Phase('modwheel')
         ev_cnt = 0
         for group in notegroups:
             for ns in group.streams:
-                i = 0
-                while i < len(ns.history):
-                    dev = ns.history[i]
-                    if dev.modwheel > 0:
-                        realpitch = dev.pitch
-                        realamp = dev.ampl
-                        mwamp = float(dev.modwheel) / 0x3FFF
-                        dt = 0.0
-                        origtime = dev.abstime
-                        events = []
-                        while dt < dev.duration:
-                            dev.abstime = origtime + dt
-                            if options.modcont:
-                                t = origtime
-                            else:
-                                t = dt
-                            events.append(DurationEvent(dev, realpitch + mwamp * options.modfdev * math.sin(2 * math.pi * options.modffreq * t), realamp + mwamp * options.modadev * (math.sin(2 * math.pi * options.modafreq * t) - 1.0) / 2.0, min(options.modres, dev.duration - dt), dev.modwheel))
-                            dt += options.modres
-                        ns.history[i:i+1] = events
-                        i += len(events)
-                        ev_cnt += len(events)
-                        if options.verbose:
-                            print 'Event', i, 'note', dev, 'in group', group.name, 'resolved to', len(events), 'events'
-                            if options.debug:
-                                for ev in events:
-                                    print '\t', ev
-                    else:
-                        i += 1
+                src = ns.history
+                history = NoteHistory()
+                window = RateWindow(src.abstime)
+                lo = 0  # Start of the run of unmodulated notes before i
+                for i in numpy.flatnonzero(src.Column('modwheel')).tolist():
+                    history.Extend(src, lo, i)
+                    if options.maxrate > 0:
+                        window.Extend(src.abstime[lo:i])
+                    lo = i + 1
+                    cnt = modwheel_notes(src, i, history, window)
+                    ev_cnt += cnt
+                    if options.verbose:
+                        print 'Event', len(history), 'note', src.Row(i), 'in group', group.name, 'resolved to', cnt, 'events'
+                        if options.debug:
+                            for j in xrange(len(history) - cnt, len(history)):
+                                print '\t', history.Row(j)
+                history.Extend(src, lo)
+                ns.history = history
         print '...resolved', ev_cnt, 'events'
+        prof.Items(ev_cnt)
 
     if options.stringres:
         print 'Resolving string models...'
+        prof.Phase('string')
+
+        def string_run(dt, ampf, rate, limit, ampl, dur=None):
+            # Offsets and amplitude factors of consecutive string model steps,
+            # and how many of them (at most limit) are above the threshold
+            # (and, if dur is given, start before it).
+            size = 16
+            while True:
+                size = min(size, limit)
+                dts = step_offsets(dt, options.stringres, size)
+                ampfs = numpy.multiply.accumulate(numpy.append(ampf, numpy.repeat(rate, size - 1)))
+                ok = ampfs * ampl >= options.stringthres
+                if dur is not None:
+                    ok &= dts < dur
+                if not ok.all():
+                    return dts, ampfs, int(ok.argmin())
+                if size == limit:
+                    return dts, ampfs, size
+                size *= 4
+
+        rate_on = options.stringrateon ** options.stringres
+        rate_off = options.stringrateoff ** options.stringres
         st_cnt = sum(sum(len(ns.history) for ns in group.streams) for group in notegroups)
         in_cnt = 0
         ex_cnt = 0
         ev_cnt = 0
-        dev_grps = []
+        string_notes = NoteHistory()
+        dev_grps = []  # (lo, hi) ranges of string_notes, one per source note
         for group in notegroups:
             for ns in group.streams:
-                i = 0
-                while i < len(ns.history):
-                    dev = ns.history[i]
-                    ntime = float('inf')
-                    if i + 1 < len(ns.history):
-                        ntime = ns.history[i+1].abstime
-                    dt = 0.0
-                    ampf = 1.0
-                    origtime = dev.abstime
-                    events = []
-                    while dt < dev.duration and ampf * dev.ampl >= options.stringthres:
-                        dev.abstime = origtime + dt
-                        events.append(DurationEvent(dev, dev.pitch, ampf * dev.ampl, min(options.stringres, dev.duration - dt), dev.modwheel))
-                        if len(events) > options.stringmax:
-                            print 'WARNING: Exceeded maximum string model events for event', i
-                            if options.verbose:
-                                print 'Final ampf', ampf, 'dt', dt
-                            break
-                        ampf *= options.stringrateon ** options.stringres
-                        dt += options.stringres
-                        in_cnt += 1
-                    dt = dev.duration
-                    while ampf * dev.ampl >= options.stringthres:
-                        dev.abstime = origtime + dt
-                        events.append(DurationEvent(dev, dev.pitch, ampf * dev.ampl, options.stringres, dev.modwheel))
-                        if len(events) > options.stringmax:
-                            print 'WARNING: Exceeded maximum string model events for event', i
-                            if options.verbose:
-                                print 'Final ampf', ampf, 'dt', dt
-                            break
-                        ampf *= options.stringrateoff ** options.stringres
-                        dt += options.stringres
-                        ex_cnt += 1
-                    if events:
-                        for j in xrange(len(events) - 1):
-                            cur, next = events[j], events[j + 1]
-                            if abs(cur.abstime + cur.duration - next.abstime) > options.epsilon:
-                                print 'WARNING: String model events cur: ', cur, 'next:', next, 'have gap/overrun of', next.abstime - (cur.abstime + cur.duration)
-                        dev_grps.append(events)
+                hist = ns.history
+                window = RateWindow(hist.abstime)
+                for i in xrange(len(hist)):
+                    dev = hist.Row(i)
+                    dts_in, ampfs_in, n_in = string_run(0.0, 1.0, rate_on, options.stringmax + 1, dev.ampl, dev.duration)
+                    if n_in > options.stringmax:
+                        print 'WARNING: Exceeded maximum string model events for event', i
+                        if options.verbose:
+                            print 'Final ampf', float(ampfs_in[n_in - 1]), 'dt', float(dts_in[n_in - 1])
+                        ampf = ampfs_in[n_in - 1]
+                        in_cnt += n_in - 1
+                    else:
+                        ampf = ampfs_in[n_in]
+                        in_cnt += n_in
+                    dts_ex, ampfs_ex, n_ex = string_run(dev.duration, ampf, rate_off, max(options.stringmax - n_in, 0) + 1, dev.ampl)
+                    if n_ex > 0 and n_in + n_ex > options.stringmax:
+                        print 'WARNING: Exceeded maximum string model events for event', i
+                        if options.verbose:
+                            print 'Final ampf', float(ampfs_ex[n_ex - 1]), 'dt', float(dts_ex[n_ex - 1])
+                        ex_cnt += n_ex - 1
+                    else:
+                        ex_cnt += n_ex
+                    times = dev.abstime + numpy.concatenate((dts_in[:n_in], dts_ex[:n_ex]))
+                    ampls = numpy.concatenate((ampfs_in[:n_in], ampfs_ex[:n_ex])) * dev.ampl
+                    durs = numpy.concatenate((numpy.minimum(options.stringres, dev.duration - dts_in[:n_in]), numpy.repeat(options.stringres, n_ex)))
+                    lo = len(string_notes)
+                    times, pitches, ampls, durs = limit_rate(times, numpy.repeat(hist.pitch[i], len(times)), ampls, durs, window)
+                    string_notes.Expand(hist, i, times.tolist(), pitches.tolist(), ampls.tolist(), durs.tolist(), hist.bent[i])
+                    hi = len(string_notes)
+                    if hi > lo:
+                        for j in numpy.flatnonzero(numpy.abs(times[:-1] + durs[:-1] - times[1:]) > options.epsilon).tolist():
+                            cur, nxt = string_notes.Row(lo + j), string_notes.Row(lo + j + 1)
+                            print 'WARNING: String model events cur: ', cur, 'next:', nxt, 'have gap/overrun of', nxt.abstime - (cur.abstime + cur.duration)
+                        dev_grps.append((lo, hi))
                     else:
                         print 'WARNING: Event', i, 'note', dev, ': No events?'
                     if options.verbose:
-                        print 'Event', i, 'note', dev, 'in group', group.name, 'resolved to', len(events), 'events'
+                        print 'Event', i, 'note', dev, 'in group', group.name, 'resolved to', hi - lo, 'events'
                         if options.debug:
-                            for ev in events:
-                                print '\t', ev
-                    i += 1
-                    ev_cnt += len(events)
+                            for j in xrange(lo, hi):
+                                print '\t', string_notes.Row(j)
+                    ev_cnt += hi - lo
         print '...resolved', ev_cnt, 'events (+', ev_cnt - st_cnt, ',', in_cnt, 'inside', ex_cnt, 'extra), resorting streams...'
-        for group in notegroups:
-            group.streams = []
-
-        dev_grps.sort(key = lambda evg: evg[0].abstime)
-        for devgr in dev_grps:
-            dev = devgr[0]
-            for group in notegroups:
-                if group.filter(dev):
-                    grp = group
-                    break
-            else:
+        group_items = dict((group, []) for group in notegroups)
+
+        dev_grps.sort(key = lambda (lo, hi): string_notes.abstime[lo])
+        for lo, hi in dev_grps:
+            dev = string_notes.Row(lo)
+            grp = dispatch.Find(string_notes.Key(lo), dev)
+            if grp is None:
                 grp = NSGroup()
                 notegroups.append(grp)
-            for ns in grp.streams:
-                if not ns.history:
-                    ns.history.extend(devgr)
-                    break
-                last = ns.history[-1]
-                if dev.abstime >= last.abstime + last.duration - 1e-3:
-                    ns.history.extend(devgr)
-                    break
-            else:
-                ns = NoteStream()
-                grp.streams.append(ns)
-                ns.history.extend(devgr)
+                group_items[grp] = []
+            group_items[grp].append((dev.abstime, string_notes.abstime[hi - 1] + string_notes.duration[hi - 1], lo, hi))
+
+        for group in notegroups:
+            pack_streams(group, group_items[group], string_notes, 1e-3)
         scnt = 0
         for group in notegroups:
             for ns in group.streams:
                 scnt += 1
         print 'Final sort:', len(notegroups), 'groups with', scnt, 'streams'
+        prof.Items(ev_cnt)
 
-    if not options.keepempty:
+    if not options.keepempty and spiller is None:
         print 'Culling empty events...'
+        prof.Phase('cull')
         ev_cnt = 0
         for group in notegroups:
             for ns in group.streams:
-                i = 0
-                while i < len(ns.history):
-                    if ns.history[i].duration == 0.0:
-                        del ns.history[i]
-                        ev_cnt += 1
-                    else:
-                        i += 1
+                keep = ns.history.Column('duration') != 0.0
+                if not keep.all():
+                    ev_cnt += len(keep) - int(keep.sum())
+                    ns.history.Compress(keep)
         print '...culled', ev_cnt, 'events'
+        prof.Items(ev_cnt)
 
     if options.verbose:
         print 'Final group mappings:'
@@ -657,91 +1420,168 @@ for fname in args:
             print ('<anonymous>' if group.name is None else group.name), '<=', '(', len(group.streams), 'streams)'
 
     print 'Final volume resolution...'
+    prof.Phase('volume')
     for group in notegroups:
         for ns in group.streams:
-            for ev in ns.history:
-                t, vol = sorted(filter(lambda pair: pair[0] <= ev.abstime, vol_at[ev.tidx][ev.ev.channel].items()), key=lambda pair: pair[0])[-1]
-                ev.ampl *= (float(vol) / 0x3FFF) ** options.vol_pow
+            resolve_volume(ns.history)
 
     print 'Checking consistency...'
+    prof.Phase('check')
     for group in notegroups:
         if options.verbose:
             print 'Group', '<None>' if group.name is None else group.name, 'with', len(group.streams), 'streams...',
         ecnt = 0
         for ns in group.streams:
-            for i in xrange(len(ns.history) - 1):
-                cur, next = ns.history[i], ns.history[i + 1]
-                if cur.abstime + cur.duration > next.abstime + options.epsilon:
-                    print 'WARNING: event', i, 'collides with next event (@', cur.abstime, '+', cur.duration, 'next @', next.abstime, ';', next.abstime - (cur.abstime + cur.duration), 'overlap)'
-                    ecnt += 1
-                if cur.abstime > next.abstime:
-                    print 'WARNING: event', i + 1, 'out of sort order (@', cur.abstime, 'next @', next.abstime, ';', cur.abstime - next.abstime, 'underlap)'
-                    ecnt += 1
+            hist = ns.history
+            abstimes, durs = hist.Column('abstime'), hist.Column('duration')
+            suspect = (abstimes[:-1] + durs[:-1] > abstimes[1:] + options.epsilon) | (abstimes[:-1] > abstimes[1:])
+            for i in numpy.flatnonzero(suspect).tolist():
+                ecnt += check_pair(i, hist.abstime[i], hist.duration[i], hist.abstime[i + 1])
         if options.verbose:
             if ecnt > 0:
                 print '...', ecnt, 'errors occured'
             else:
                 print 'ok'
 
+    if options.maxrate > 0:
+        print 'Thinned', rate_stats['thinned'], 'modwheel and string model events to stay within', options.maxrate, 'per second'
+
+    if options.verbose and spiller is None:
+        print 'Event rates per stream (mean over its playing time, peak in any second):'
+        for group in notegroups:
+            for ns in group.streams:
+                abstimes = ns.history.Column('abstime')
+                if not len(abstimes):
+                    continue
+                span = (abstimes + ns.history.Column('duration')).max() - abstimes[0]
+                peak = (numpy.searchsorted(abstimes, abstimes + 1.0) - numpy.arange(len(abstimes))).max()
+                print '  %s/%d: %d events, %.1f/s mean, %d/s peak%s'%('<anonymous>' if group.name is None else group.name, ns.index, len(abstimes), len(abstimes) / span if span > 0 else 0.0, peak, ' (over --max-rate)' if 0 < options.maxrate < peak else '')
+
     print 'Generated %d streams in %d groups'%(sum(map(lambda x: len(x.streams), notegroups)), len(notegroups))
     print 'Playtime:', lastabstime, 'seconds'
 
 ##### Write to XML and exit #####
 
-    ivmeta = ET.SubElement(iv, 'meta')
-    abstime = 0
-    prevticks = 0
-    prev_bpm = 120
-    for tidx, bpms in enumerate(bpm_at):
+    prof.Phase('write')
+    ivf = open(ivname, 'wb')
+    ivw = IVWriter(ivf)
+    ivw.Open('iv', **root_attrs(fname))
+
+    ivmeta = ET.Element('meta')
+    for tidx, tmap in enumerate(tempo_maps):
         ivbpms = ET.SubElement(ivmeta, 'bpms', track=str(tidx))
-        for absticks, bpm in sorted(bpms.items(), key = lambda pair: pair[0]):
-            abstime += ((absticks - prevticks) * 60.0) / (prev_bpm * pat.resolution)
-            prevticks = absticks
+        for absticks, bpm, abstime in tmap:
             ivbpm = ET.SubElement(ivbpms, 'bpm')
             ivbpm.set('bpm', str(bpm))
             ivbpm.set('ticks', str(absticks))
             ivbpm.set('time', str(abstime))
+    ivmeta.append(args_element())
+    ivw.Element(ivmeta)
 
-    ivstreams = ET.SubElement(iv, 'streams')
+    ivw.Open('streams')
 
     for group in notegroups:
             for ns in group.streams:
-                    ivns = ET.SubElement(ivstreams, 'stream')
-                    ivns.set('type', 'ns')
+                    attrs = {'type': 'ns'}
                     if group.name is not None:
-                            ivns.set('group', group.name)
-                    for note in ns.history:
-                            ivnote = ET.SubElement(ivns, 'note')
-                            ivnote.set('pitch', str(note.pitch))
-                            ivnote.set('vel', str(int(note.ampl * 127.0)))
-                            ivnote.set('ampl', str(note.ampl))
-                            ivnote.set('time', str(note.abstime))
-                            ivnote.set('dur', str(note.real_duration))
+                            attrs['group'] = group.name
+                    if not note_count(ns):
+                            ivw.Empty('stream', **attrs)
+                            continue
+                    ivw.Open('stream', **attrs)
+                    if spiller is None:
+                        ivf.writelines(ns.history.Tags())
+                    else:
+                        spiller.CopyTo(Spiller.Key(ns), ivf)
+                    ivw.Close()
 
     if not options.no_text:
-        ivtext = ET.SubElement(ivstreams, 'stream', type='text')
-        for tev in textstream:
-            text = tev.ev.text
-            try:
-                text = text.decode('utf8')
-            except UnicodeDecodeError:
-                text = 'base64:' + text.encode('base64')
-            ivev = ET.SubElement(ivtext, 'text', time=str(tev.abstime), type=type(tev.ev).__name__, text=text)
-
-    ivaux = ET.SubElement(ivstreams, 'stream')
-    ivaux.set('type', 'aux')
-
-    fw = midi.FileWriter()
-    fw.RunningStatus = None # XXX Hack
-
-    for mev in auxstream:
-        ivev = ET.SubElement(ivaux, 'ev')
-        ivev.set('time', str(mev.abstime))
-        ivev.set('data', repr(fw.encode_midi_event(mev.ev)))
+        if spiller is None:
+            ivtext = ET.Element('stream', type='text')
+            for tev in textstream:
+                ET.SubElement(ivtext, 'text', text_attrs(tev))
+            ivw.Element(ivtext)
+        elif spiller.Count('text'):
+            ivw.Open('stream', type='text')
+            spiller.CopyTo('text', ivf)
+            ivw.Close()
+        else:
+            ivw.Empty('stream', type='text')
 
-    ivargs = ET.SubElement(ivmeta, 'args')
-    ivargs.text = ' '.join('%r' % (i,) for i in sys.argv[1:])
+    if auxstream or (spiller is not None and spiller.Count('aux')):
+        ivw.Open('stream', type='aux')
+        if spiller is None:
+            for mev in auxstream:
+                ivw.Empty('ev', **aux_attrs(mev))
+        else:
+            spiller.CopyTo('aux', ivf)
+        ivw.Close()
+    else:
+        ivw.Empty('stream', type='aux')
 
+    ivw.Close()
+    ivw.Close()
+    ivf.close()
+    if spiller is not None:
+        spiller.Close()
     print 'Done.'
-    txt = ET.tostring(iv, 'UTF-8')
-    open(os.path.splitext(os.path.basename(fname))[0]+'.iv', 'wb').write(txt)
+    result = (sum(note_count(ns) for group in notegroups for ns in group.streams), sum(len(group.streams) for group in notegroups))
+    prof.Items(result[0])
+    prof.End()
+    if options.profile:
+        prof.Report()
+    if options.profile_json:
+        f = open(os.path.splitext(ivname)[0] + '.profile.json', 'w')
+        json.dump({'file': fname, 'phases': prof.phases}, f, indent=4)
+        f.close()
+    if key is not None:
+        try:
+            cache.Store(key, ivname, result)
+        except (IOError, OSError), e:
+            print 'WARNING: Could not store', ivname, 'in the conversion cache (%s)'%(e,)
+    return result
+
+def convert_logged(fname):
+    '''Runs convert() in a --jobs worker, capturing its output so that it can
+    be printed in order, and isolating any failure to this file.'''
+    log = StringIO.StringIO()
+    sys.stdout = sys.stderr = log
+    start = time.time()
+    try:
+        result = convert(fname)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        print fname, ': Exception occurred during conversion, skipping...'
+        result = None
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return log.getvalue(), time.time() - start, result
+
+cache = None
+if not (options.no_cache or options.chansfname or options.verbose or options.debug or options.profile or options.profile_json or options.profile_phase):
+    try:
+        cache = ConversionCache(options.cache_dir, int(options.cache_size * 1024 * 1024))
+    except (IOError, OSError), e:
+        print 'WARNING: Could not open the conversion cache (%s); converting without it'%(e,)
+
+if options.jobs > 1:
+    pool = multiprocessing.Pool(options.jobs)
+    summary = []
+    for fname, (log, elapsed, result) in zip(args, pool.imap(convert_logged, args)):
+        sys.stdout.write(log)
+        sys.stdout.flush()
+        summary.append((fname, elapsed, result))
+    pool.close()
+    pool.join()
+    print
+    print 'File, time (s), notes, streams:'
+    for fname, elapsed, result in summary:
+        if result is None:
+            print fname, ',', '%.3f'%(elapsed,), ', FAILED'
+        else:
+            print fname, ',', '%.3f'%(elapsed,), ',', result[0], ',', result[1]
+    print 'Converted', sum(1 for fname, elapsed, result in summary if result is not None), 'of', len(summary), 'files in', '%.3f'%(sum(elapsed for fname, elapsed, result in summary),), 'seconds of conversion time'
+else:
+    for fname in args:
+        convert(fname)
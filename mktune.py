@@ -1,4 +1,4 @@
-from xml.etree import ElementTree as ET
+import ivload
 import optparse
 
 parser = optparse.OptionParser()
@@ -30,7 +30,8 @@ def to_beats(tm):
 
 for fname in args:
     try:
-        iv = ET.parse(fname).getroot()
+        iv = ivload.load(fname, True)
+        ns = iv.NoteStreams()[0]
     except IOError:
         import traceback
         traceback.print_exc()
@@ -39,15 +40,9 @@ for fname in args:
 
     print options.tempo,
 
-    ns = iv.find('./streams/stream[@type="ns"]')
     prevn = None
-    for note in ns.findall('note'):
-        n = Note(
-            float(note.get('time')),
-            float(note.get('dur')),
-            float(note.get('pitch')) + options.transpose,
-            float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0)),
-        )
+    for time, dur, pitch, ampl in ns.Notes():
+        n = Note(time, dur, pitch + options.transpose, ampl)
         if prevn is not None:
             rtime = to_beats(n.time - (prevn.time + prevn.dur))
             if rtime >= 1:
@@ -1,6 +1,6 @@
 # IV file viewer
 
-import xml.etree.ElementTree as ET
+import ivload
 import optparse
 import sys
 import math
@@ -62,6 +62,9 @@ if options.almost_all or options.all:
         options.histogram_tracks= True
         options.vel_hist_tracks = True
 
+# Read the notes along with the streams if anything below needs them
+need_notes = options.notes or options.notes_stream or options.histogram or options.histogram_tracks or options.vel_hist or options.vel_hist_tracks or options.duration or options.duty_cycle
+
 if options.no_color:
     class COL:
         NONE=''
@@ -122,7 +125,8 @@ for fname in args:
     print
     print 'File :', fname
     try:
-        iv = ET.parse(fname).getroot()
+        iv = ivload.load(fname, need_notes)
+        meta = iv.Meta()
     except Exception:
         import traceback
         traceback.print_exc()
@@ -132,7 +136,6 @@ for fname in args:
 
     if options.meta:
         print 'Metatrack:',
-        meta = iv.find('./meta')
         if len(meta):
             print 'exists'
             print '\tBPM track:',
@@ -145,12 +148,12 @@ for fname in args:
     if not (options.number or options.groups or options.notes or options.histogram or options.histogram_tracks or options.vel_hist or options.vel_hist_tracks or options.duration or options.duty_cycle or options.aux):
         continue
 
-    streams = iv.findall('./streams/stream')
-    notestreams = [s for s in streams if s.get('type') == 'ns']
-    auxstreams = [s for s in streams if s.get('type') == 'aux']
+    streams = iv.Streams()
+    notestreams = [s for s in streams if s.type == 'ns']
+    auxstreams = [s for s in streams if s.type == 'aux']
     if options.group:
         print 'NOTE: Restricting results to groups', options.group, 'as requested'
-        notestreams = [ns for ns in notestreams if ns.get('group', '<anonymous>') in options.group]
+        notestreams = [ns for ns in notestreams if ns.attrib.get('group', '<anonymous>') in options.group]
 
     if options.number:
         print 'Stream count:'
@@ -168,7 +171,7 @@ for fname in args:
     if options.groups:
         groups = {}
         for s in notestreams:
-            group = s.get('group', '<anonymous>')
+            group = s.attrib.get('group', '<anonymous>')
             groups[group] = groups.get(group, 0) + 1
             if options.total:
                 tot_groups[group] = tot_groups.get(group, 0) + 1
@@ -182,7 +185,7 @@ for fname in args:
         fr.RunningStatus = None  # XXX Hack
         print 'Aux stream data:'
         for aidx, astream in enumerate(auxstreams):
-            evs = astream.findall('ev')
+            evs = astream.element.findall('ev')
             failed = 0
             print '\tFrom stream {}, {} events:'.format(aidx, len(evs))
             for ev in evs:
@@ -195,7 +198,7 @@ for fname in args:
                     print '\t\tAt time {}: {}'.format(ev.get('time'), mev)
             print '\t\t(...and {} others which failed to parse)'.format(failed)
 
-    if not (options.notes or options.notes_stream or options.histogram or options.histogram_tracks or options.vel_hist or options.vel_hist_tracks or options.duration or options.duty_cycle):
+    if not need_notes:
         continue
 
     if options.notes:
@@ -216,12 +219,8 @@ for fname in args:
         cum_dur = [0.0] * len(notestreams)
 
     for sidx, stream in enumerate(notestreams):
-        notes = stream.findall('note')
-        for note in notes:
-            pitch = float(note.get('pitch'))
-            ampl = int(127 * float(note.get('ampl', float(note.get('vel', 127.0)) / 127.0)))
-            time = float(note.get('time'))
-            dur = float(note.get('dur'))
+        for time, dur, pitch, ampl in stream.Notes():
+            ampl = int(127 * ampl)
             if options.notes:
                 note_cnt += 1
                 if options.total:
@@ -250,18 +249,18 @@ for fname in args:
 
     if options.histogram_tracks:
         for sidx, hist in enumerate(pitch_tracks):
-            print 'Stream {} (group {}) pitch histogram:'.format(sidx, notestreams[sidx].get('group', '<anonymous>'))
+            print 'Stream {} (group {}) pitch histogram:'.format(sidx, notestreams[sidx].attrib.get('group', '<anonymous>'))
             show_hist(hist)
     if options.vel_hist_tracks:
         for sidx, hist in enumerate(velocities_tracks):
-            print 'Stream {} (group {}) velocity histogram:'.format(sidx, notestreams[sidx].get('group', '<anonymous>'))
+            print 'Stream {} (group {}) velocity histogram:'.format(sidx, notestreams[sidx].attrib.get('group', '<anonymous>'))
             show_hist(hist)
     if options.notes_stream:
         for sidx, value in enumerate(notes_stream):
-            print 'Stream {} (group {}) note count: {}'.format(sidx, notestreams[sidx].get('group', '<anonymous>'), value)
+            print 'Stream {} (group {}) note count: {}'.format(sidx, notestreams[sidx].attrib.get('group', '<anonymous>'), value)
     if options.duty_cycle:
         for sidx, value in enumerate(cum_dur):
-            print 'Stream {} (group {}) duty cycle: {}'.format(sidx, notestreams[sidx].get('group', '<anonymous>'), value / max_dur)
+            print 'Stream {} (group {}) duty cycle: {}'.format(sidx, notestreams[sidx].attrib.get('group', '<anonymous>'), value / max_dur)
     if options.notes:
         print 'Total notes: {}'.format(note_cnt)
     if options.histogram:
@@ -0,0 +1,169 @@
+'''
+itl_chorus -- ITL Chorus Suite
+smf -- Standard MIDI File reader
+
+A small, tolerant reader for Standard MIDI Files. Rather than building an
+object per event, each track is decoded (from a memory-mapped file) into a list
+of tuples:
+
+    (abstick, track, status, data1, data2)
+
+- For channel messages, status is the full status byte (including the channel)
+  and data1/data2 are the data bytes (data2 is 0 for program change and channel
+  aftertouch, which only have one).
+- For meta events, status is 0xFF, data1 is the meta type, and data2 is the
+  payload as a string.
+- For SysEx events, status is 0xF0 or 0xF7, data1 is 0, and data2 is the
+  payload (without the length prefix) as a string.
+
+Running status is honored (and survives meta and SysEx events, as many writers
+assume), stray bytes are skipped, non-track chunks are ignored, and truncated
+tracks keep whatever was decoded before the data ran out. Tracks can also be
+read lazily, decoding straight from the mapping whenever they are iterated.
+'''
+
+import mmap
+import struct
+
+META = 0xFF
+SYSEX = 0xF0
+SYSEX_ESCAPE = 0xF7
+
+META_TEMPO = 0x51
+META_END_OF_TRACK = 0x2F
+
+# Number of data bytes following each channel message type
+DATA_BYTES = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+class MidiFile(object):
+    '''The decoded contents of an SMF; iterating over it (or indexing it)
+    yields the tracks, each a list of event tuples sorted by abstick.'''
+    __slots__ = ['format', 'resolution', 'tracks']
+    def __init__(self, format=1, resolution=220, tracks=None):
+        self.format = format
+        self.resolution = resolution
+        self.tracks = [] if tracks is None else tracks
+    def __len__(self):
+        return len(self.tracks)
+    def __iter__(self):
+        return iter(self.tracks)
+    def __getitem__(self, idx):
+        return self.tracks[idx]
+
+class LazyTrack(object):
+    '''A track which is decoded from the (mapped) file each time it is
+    iterated, so that it never has to be held in memory.'''
+    __slots__ = ['buf', 'start', 'end', 'tidx', 'count']
+    def __init__(self, buf, start, end, tidx):
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self.tidx = tidx
+        self.count = None
+    def __iter__(self):
+        return iter_track(self.buf, self.start, self.end, self.tidx)
+    def __len__(self):
+        if self.count is None:
+            self.count = sum(1 for ev in self)
+        return self.count
+
+def iter_track(buf, start, end, tidx):
+    '''Decodes the body of one MTrk chunk (buf[start:end]), yielding event
+    tuples for track tidx.'''
+    pos = start
+    abstick = 0
+    running = 0
+    try:
+        while pos < end:
+            b = ord(buf[pos])
+            pos += 1
+            delta = b & 0x7F
+            while b & 0x80:
+                b = ord(buf[pos])
+                pos += 1
+                delta = (delta << 7) | (b & 0x7F)
+            abstick += delta
+            if pos >= end:
+                break
+            status = ord(buf[pos])
+            if status & 0x80:
+                pos += 1
+            elif running:
+                status = running
+            else:
+                pos += 1  # Data byte without any running status; skip it
+                continue
+            if status < 0xF0:
+                running = status
+                if DATA_BYTES[status & 0xF0] == 2:
+                    if pos + 2 > end:
+                        break
+                    yield (abstick, tidx, status, ord(buf[pos]), ord(buf[pos + 1]))
+                    pos += 2
+                else:
+                    if pos + 1 > end:
+                        break
+                    yield (abstick, tidx, status, ord(buf[pos]), 0)
+                    pos += 1
+            elif status == META or status == SYSEX or status == SYSEX_ESCAPE:
+                if status == META:
+                    kind = ord(buf[pos])
+                    pos += 1
+                else:
+                    kind = 0
+                b = ord(buf[pos])
+                pos += 1
+                length = b & 0x7F
+                while b & 0x80:
+                    b = ord(buf[pos])
+                    pos += 1
+                    length = (length << 7) | (b & 0x7F)
+                if pos + length > end:
+                    break
+                yield (abstick, tidx, status, kind, buf[pos:pos + length])
+                pos += length
+                if status == META and kind == META_END_OF_TRACK:
+                    break
+            # Anything else (system common/realtime) has no place in an SMF;
+            # skip the byte and resynchronize on the next one.
+    except IndexError:
+        pass  # Truncated file
+
+def map_file(fname):
+    '''The contents of the named file: a read-only mmap, or a string if it
+    can't be mapped. Close it when done, if it is an mmap.'''
+    f = open(fname, 'rb')
+    try:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            buf = f.read()  # Empty files and special files can't be mapped
+    finally:
+        f.close()
+    return buf
+
+def read(fname, lazy=False):
+    '''Reads the named SMF, returning a MidiFile. If lazy is set, the tracks
+    are LazyTracks backed by a mapping of the file rather than lists.'''
+    buf = map_file(fname)
+    try:
+        if buf[:4] != 'MThd' or len(buf) < 14:
+            raise ValueError('%s: not a Standard MIDI File'%(fname,))
+        hdrsz, format, ntracks, resolution = struct.unpack('>LHHH', buf[4:14])
+        mf = MidiFile(format, resolution)
+        pos = 8 + hdrsz
+        while pos + 8 <= len(buf):
+            magic = buf[pos:pos + 4]
+            size = struct.unpack('>L', buf[pos + 4:pos + 8])[0]
+            pos += 8
+            if magic == 'MTrk':
+                end = min(pos + size, len(buf))
+                if lazy:
+                    mf.tracks.append(LazyTrack(buf, pos, end, len(mf.tracks)))
+                else:
+                    mf.tracks.append(list(iter_track(buf, pos, end, len(mf.tracks))))
+            pos += size
+        return mf
+    finally:
+        if isinstance(buf, mmap.mmap) and not lazy:
+            buf.close()